@@ -0,0 +1,130 @@
+'''Times typical reporting queries against a database populated with synthetic
+executions, first without the Sneeze indexes and then after applying the
+schema migrations.
+    
+    python benchmarks/cycle_summary.py --cycles 20 --executions 5000
+'''
+
+
+from optparse import OptionParser
+from timeit import default_timer
+from datetime import datetime
+from sqlalchemy import create_engine, select, func
+from sneeze.database.models import Base
+from sneeze.database.interface import load_models
+from sneeze.database.migrations import upgrade
+import os, tempfile, random
+
+
+def populate(engine, models, cycles, executions, cases):
+    
+    tables = dict((name, model.__table__) for name, model in models.items())
+    now = datetime.now()
+    connection = engine.connect()
+    transaction = connection.begin()
+    connection.execute(tables['Case'].insert(),
+                       [{'id' : i, 'label' : 'benchmark.test_%d' % i} for i in xrange(1, cases + 1)])
+    execution_id = 0
+    for cycle in xrange(1, cycles + 1):
+        connection.execute(tables['TestCycle'].insert().values(id=cycle, name='cycle %d' % cycle))
+        connection.execute(tables['ExecutionBatch'].insert().values(id=cycle, environment='benchmark',
+                                                                    host='localhost', start_time=now))
+        rows, parts, links = [], [], []
+        for _ in xrange(executions):
+            execution_id += 1
+            rows.append({'id' : execution_id, 'case_id' : random.randint(1, cases),
+                         'execution_batch_id' : cycle, 'start_time' : now, 'end_time' : now,
+                         'result' : random.choice(('PASS', 'PASS', 'PASS', 'FAIL', 'SKIP'))})
+            parts.extend({'case_execution_id' : execution_id, 'part' : part}
+                         for part in ('benchmark.py', 'benchmark', 'test'))
+            links.append({'test_cycle_id' : cycle, 'case_execution_id' : execution_id,
+                          'include_in_reporting' : True})
+        connection.execute(tables['CaseExecution'].insert(), rows)
+        connection.execute(tables['CaseExecutionAddressPart'].insert(), parts)
+        connection.execute(tables['TestCycleCaseExecution'].insert(), links)
+    transaction.commit()
+    connection.close()
+
+
+def queries(models, cycles, cases):
+    
+    execution = models['CaseExecution'].__table__
+    link = models['TestCycleCaseExecution'].__table__
+    case = models['Case'].__table__
+    part = models['CaseExecutionAddressPart'].__table__
+    cycle_id, case_id = cycles // 2 or 1, cases // 2 or 1
+    return [('cycle summary',
+             select([execution.c.result, func.count()])
+             .select_from(link.join(execution, execution.c.id==link.c.case_execution_id))
+             .where(link.c.test_cycle_id==cycle_id)
+             .group_by(execution.c.result)),
+            ('batch summary',
+             select([execution.c.result, func.count()])
+             .where(execution.c.execution_batch_id==cycle_id)
+             .group_by(execution.c.result)),
+            ('case history',
+             select([execution.c.id, execution.c.result, link.c.test_cycle_id])
+             .select_from(execution.join(link, execution.c.id==link.c.case_execution_id)
+                          .join(case, case.c.id==execution.c.case_id))
+             .where(case.c.label=='benchmark.test_%d' % case_id)),
+            ('failure addresses',
+             select([part.c.case_execution_id, part.c.part])
+             .select_from(link.join(execution, execution.c.id==link.c.case_execution_id)
+                          .join(part, part.c.case_execution_id==execution.c.id))
+             .where(link.c.test_cycle_id==cycle_id)
+             .where(execution.c.result=='FAIL'))]
+
+
+def time_queries(engine, queries, repeat):
+    
+    timings = []
+    connection = engine.connect()
+    for name, query in queries:
+        started = default_timer()
+        for _ in xrange(repeat):
+            connection.execute(query).fetchall()
+        timings.append((name, (default_timer() - started) / repeat))
+    connection.close()
+    return timings
+
+
+def main():
+    
+    parser = OptionParser()
+    parser.add_option('--db', default='', dest='db',
+                      help='SQLAlchemy connection string for an empty database; defaults to a temporary SQLite file.')
+    parser.add_option('--cycles', default=20, type=int, dest='cycles')
+    parser.add_option('--executions', default=5000, type=int, dest='executions',
+                      help='Executions per cycle.')
+    parser.add_option('--cases', default=2000, type=int, dest='cases')
+    parser.add_option('--repeat', default=20, type=int, dest='repeat')
+    options, _ = parser.parse_args()
+    path = None
+    if options.db:
+        db = options.db
+    else:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        db = 'sqlite:///' + path
+    try:
+        engine = create_engine(db)
+        models = load_models(Base)
+        Base.metadata.create_all(engine)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(engine)
+        populate(engine, models, options.cycles, options.executions, options.cases)
+        benchmark_queries = queries(models, options.cycles, options.cases)
+        before = time_queries(engine, benchmark_queries, options.repeat)
+        upgrade(engine, Base)
+        after = time_queries(engine, benchmark_queries, options.repeat)
+        print '%-20s %14s %14s' % ('query', 'no indexes ms', 'indexed ms')
+        for (name, unindexed), (_, indexed) in zip(before, after):
+            print '%-20s %14.3f %14.3f' % (name, unindexed * 1000, indexed * 1000)
+    finally:
+        if path:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''Measures the per-test cost of dispatching plugin manager hooks with 0, 5 and
+20 managers attached, against the same calls made by checking every manager
+with ``hasattr``\ .  No database is involved; events go to a recorder that
+drops them.
+    
+    python benchmarks/hook_dispatch.py --tests 100000
+'''
+
+
+from optparse import OptionParser
+from timeit import default_timer
+from sneeze.database.interface import WorkerTissue
+
+
+# Hooks called for every test by the Tissue and the nose plugin
+TEST_HOOKS = [('before_enter_case', 2), ('after_enter_case', 2), ('handle_pass', 0),
+              ('before_exit_case', 1), ('after_exit_case', 1)]
+
+
+class NullRecorder(object):
+    
+    def put(self, event):
+        
+        pass
+
+
+class Manager(object):
+    """Defines every other per-test hook, like a typical plugin manager."""
+    
+    def before_enter_case(self, case, description):
+        
+        pass
+    
+    def handle_pass(self):
+        
+        pass
+    
+    def after_exit_case(self, result):
+        
+        pass
+
+
+def hasattr_dispatch(tissue, tests):
+    
+    started = default_timer()
+    for i in xrange(tests):
+        for name, arity in TEST_HOOKS:
+            for manager in tissue.plugin_managers:
+                if hasattr(manager, name):
+                    getattr(manager, name)(*(None,) * arity)
+    return (default_timer() - started) / tests
+
+
+def table_dispatch(tissue, tests):
+    
+    started = default_timer()
+    for i in xrange(tests):
+        for name, arity in TEST_HOOKS:
+            for hook in tissue.hooks(name):
+                hook(*(None,) * arity)
+    return (default_timer() - started) / tests
+
+
+def tissue_cycle(tissue, tests):
+    
+    started = default_timer()
+    for i in xrange(tests):
+        tissue.enter_case('benchmark.test', ['benchmark.py', 'benchmark', 'test'])
+        tissue.exit_case('PASS')
+    return (default_timer() - started) / tests
+
+
+def main():
+    
+    parser = OptionParser()
+    parser.add_option('--tests', default=100000, type=int, dest='tests')
+    options, args = parser.parse_args()
+    print '%8s %14s %14s %14s' % ('managers', 'hasattr us', 'table us', 'tissue us')
+    for managers in (0, 5, 20):
+        tissue = WorkerTissue(NullRecorder())
+        for i in xrange(managers):
+            tissue.add_plugin_manager(Manager())
+        print '%8d %14.3f %14.3f %14.3f' % (managers,
+                                            hasattr_dispatch(tissue, options.tests) * 1e6,
+                                            table_dispatch(tissue, options.tests) * 1e6,
+                                            tissue_cycle(tissue, options.tests) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
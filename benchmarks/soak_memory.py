@@ -0,0 +1,95 @@
+'''Checks that a :doc:`Tissue <tissue>` recording a very long run keeps its
+memory flat.  Records synthetic passing cases into a throwaway SQLite file,
+sampling the process RSS as it goes, and exits non-zero if RSS grows by more
+than the tolerance between the end of the warm up and the end of the run.  The
+warm up should be long enough for the case cache to fill.
+    
+    python benchmarks/soak_memory.py --cases 200000
+    python benchmarks/soak_memory.py --cases 200000 --long-lived-session
+
+An in-memory database would grow with the results it holds, so the database is
+always a file.  RSS is read from ``/proc``\ , so the check runs on Linux only.
+'''
+
+
+from optparse import OptionParser
+from timeit import default_timer
+from sqlalchemy import create_engine, event
+import os, sys, gc, shutil, tempfile
+
+
+def rss():
+    
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def fast_sqlite(engine):
+    
+    # Durability does not matter for a throwaway database, and syncing every
+    # commit would make a long soak take hours
+    def connect(dbapi_connection, connection_record):
+        
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.execute('PRAGMA journal_mode=MEMORY')
+        cursor.close()
+    
+    event.listen(engine, 'connect', connect)
+
+
+def main():
+    
+    parser = OptionParser()
+    parser.add_option('--cases', default=200000, type=int, dest='cases')
+    parser.add_option('--warm-up', default=25000, type=int, dest='warm_up',
+                      help='Cases recorded before the baseline RSS is taken.')
+    parser.add_option('--interval', default=10000, type=int, dest='interval',
+                      help='Cases recorded between RSS samples.')
+    parser.add_option('--tolerance', default=4.0, type=float, dest='tolerance',
+                      help='Allowed RSS growth after the warm up, in MB.')
+    parser.add_option('--case-cache-size', default=10000, type=int, dest='case_cache_size')
+    parser.add_option('--long-lived-session', action='store_true', default=False,
+                      dest='long_lived_session')
+    parser.add_option('--unbounded', action='store_true', default=False, dest='unbounded',
+                      help='Record without bounded_memory, for comparison.')
+    options, args = parser.parse_args()
+    from sneeze.database.interface import Tissue
+    directory = tempfile.mkdtemp()
+    try:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'sneeze.db'))
+        fast_sqlite(engine)
+        tissue = Tissue(None, 'soak', 'Memory soak', 'benchmark', 'localhost', '',
+                        engine=engine,
+                        long_lived_session=options.long_lived_session,
+                        case_cache_size=options.case_cache_size,
+                        bounded_memory=not options.unbounded)
+        tissue.start()
+        baseline = None
+        started = default_timer()
+        for i in xrange(1, options.cases + 1):
+            name = 'test_%d' % i
+            tissue.enter_case('soak.%s' % name, ['soak.py', 'soak', name])
+            tissue.exit_case('PASS')
+            if i == options.warm_up or i % options.interval == 0 or i == options.cases:
+                gc.collect()
+                sample = rss()
+                if i == options.warm_up:
+                    baseline = sample
+                print '%9d cases %8.1f MB %8.1f cases/s' % (i, sample / 2. ** 20,
+                                                         i / (default_timer() - started))
+        tissue.exit()
+    finally:
+        shutil.rmtree(directory)
+    if baseline is None:
+        print 'Run fewer cases than the warm up; nothing to check.'
+        return 0
+    growth = (sample - baseline) / 2. ** 20
+    print 'RSS grew %.1f MB after the warm up (tolerance %.1f MB)' % (growth, options.tolerance)
+    return 1 if growth > options.tolerance else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
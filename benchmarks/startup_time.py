@@ -0,0 +1,81 @@
+'''Measures how long Sneeze adds to starting a test run: importing the plugin,
+resolving the host name, and running a one test suite with Sneeze disabled and
+enabled.  Every measurement runs in a fresh interpreter; medians are reported.
+    
+    python benchmarks/startup_time.py --repeat 10
+'''
+
+
+from optparse import OptionParser
+from timeit import default_timer
+import os, sys, shutil, subprocess, tempfile
+
+
+IMPORT = '''
+from timeit import default_timer
+started = default_timer()
+import sneeze.nose_interface
+import sys
+print default_timer() - started, int('sqlalchemy' in sys.modules)
+'''
+
+HOST = '''
+from timeit import default_timer
+from sneeze.nose_interface import resolve_host
+started = default_timer()
+resolve_host()
+print default_timer() - started
+'''
+
+RUN = '''
+import nose, sys
+nose.run(argv=['nosetests', '-q'] + sys.argv[1:])
+'''
+
+
+def median(values):
+    
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def python(code, *args):
+    
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.check_output([sys.executable, '-c', code] + list(args), stderr=devnull)
+
+
+def timed_run(*args):
+    
+    started = default_timer()
+    python(RUN, *args)
+    return default_timer() - started
+
+
+def main():
+    
+    parser = OptionParser()
+    parser.add_option('--repeat', default=10, type=int, dest='repeat')
+    options, args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        suite = os.path.join(directory, 'test_startup.py')
+        with open(suite, 'w') as suite_file:
+            suite_file.write('def test_startup():\n    pass\n')
+        imports = [python(IMPORT).split() for i in xrange(options.repeat)]
+        print 'import sneeze.nose_interface  %8.1f ms  (SQLAlchemy imported: %s)' % (
+            median(float(seconds) for seconds, loaded in imports) * 1e3,
+            'yes' if any(int(loaded) for seconds, loaded in imports) else 'no')
+        print 'resolve_host                  %8.1f ms' % (
+            median(float(python(HOST)) for i in xrange(options.repeat)) * 1e3)
+        print 'one test, Sneeze disabled     %8.1f ms' % (
+            median(timed_run(suite) for i in xrange(options.repeat)) * 1e3)
+        print 'one test, Sneeze enabled      %8.1f ms' % (
+            median(timed_run(suite, '--reporting-db-config=sqlite://', '--test-cycle-name=startup')
+                   for i in xrange(options.repeat)) * 1e3)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
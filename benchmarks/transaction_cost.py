@@ -0,0 +1,53 @@
+'''Measures the per-test cost of recording case executions through a Tissue as
+the number of executions already in the :term:`Test Cycle` grows.  The cost
+should stay flat from the first test to the last.
+    
+    python benchmarks/transaction_cost.py --tests 50000 --window 5000
+'''
+
+
+from optparse import OptionParser
+from timeit import default_timer
+from sneeze.database.interface import Tissue
+
+
+def run(db_config_string, tests, window, **tissue_options):
+    
+    tissue = Tissue(db_config_string, 'benchmark', 'transaction cost benchmark',
+                    'benchmark', 'localhost', '', **tissue_options)
+    tissue.start()
+    timings = []
+    started = default_timer()
+    for i in xrange(tests):
+        label = 'benchmark.test_%d' % i
+        tissue.enter_case(label, ['benchmark.py', 'benchmark', 'test_%d' % i])
+        tissue.exit_case('PASS')
+        if (i + 1) % window == 0:
+            now = default_timer()
+            timings.append((i + 1, (now - started) / window))
+            started = now
+    tissue.exit()
+    return timings
+
+
+def main():
+    
+    parser = OptionParser()
+    parser.add_option('--db', default='sqlite://', dest='db',
+                      help='SQLAlchemy connection string; defaults to in-memory SQLite.')
+    parser.add_option('--tests', default=50000, type=int, dest='tests')
+    parser.add_option('--window', default=5000, type=int, dest='window')
+    parser.add_option('--long-lived-session', action='store_true', default=False,
+                      dest='long_lived_session')
+    options, _ = parser.parse_args()
+    timings = run(options.db, options.tests, options.window,
+                  long_lived_session=options.long_lived_session)
+    print '%10s %16s' % ('tests', 'ms per test')
+    for count, seconds in timings:
+        print '%10d %16.3f' % (count, seconds * 1000)
+    first, last = timings[0][1], timings[-1][1]
+    print 'last/first window ratio: %.2f' % (last / first)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,5 +15,10 @@ setup(name='nose-sneeze',
       packages=find_packages(),
       install_requires=['SQLAlchemy',
                         'nose-for-sneeze',
-                        'passlib'],
-      entry_points={'nose.plugins.0.10' : ['sneeze = sneeze.nose_interface:Sneeze']})
+                        'passlib',
+                        # Reads entry points without importing pkg_resources
+                        'importlib_metadata; python_version < "3.8"'],
+      entry_points={'nose.plugins.0.10' : ['sneeze = sneeze.nose_interface:Sneeze'],
+                    'console_scripts' : ['sneeze-upgrade-db = sneeze.database.migrations:main',
+                                         'sneeze-upload-spool = sneeze.database.spool:main',
+                                         'sneeze-prune-db = sneeze.database.retention:main']})
@@ -0,0 +1,175 @@
+'''A non-blocking front end to a :doc:`Tissue <tissue>` for event loop driven
+test runners and services.  Every call is run in an executor and returns a
+future, and concurrent cases each record through their own session rather than
+through the Tissue's ``access_lock``\ .
+'''
+
+
+from threading import Lock
+from datetime import datetime
+
+
+def _wait_for(value):
+    
+    # Hooks may return a future to be waited on
+    if hasattr(value, 'result') and callable(value.result):
+        return value.result()
+    return value
+
+
+class AsyncTissue(object):
+    """Wraps a started :class:`~sneeze.database.interface.Tissue` so that cases
+    can be recorded concurrently and without blocking the caller.
+    
+    Unlike the Tissue, which tracks one current :term:`Case Execution`\ , the
+    ``AsyncTissue`` hands out the id of each execution it enters; pass it back
+    to :meth:`exit_case`\ .  Executions entered here are not bracketed by
+    :term:`Default Case` executions, and the ``before_enter_case``\ ,
+    ``after_enter_case``\ , ``before_exit_case`` and ``after_exit_case`` plugin
+    hooks run in the executor, where ``Tissue.case_execution`` does not refer
+    to the case at hand.  A hook that returns a future is waited on.
+    """
+    
+    def __init__(self, tissue, executor=None, max_workers=8):
+        """
+        :param tissue: A started ``Tissue`` without a ``recorder``\ .
+        :type tissue: :class:`~sneeze.database.interface.Tissue`
+        :param executor: A ``concurrent.futures`` style executor to run calls
+            in.  If ``None``, a ``ThreadPoolExecutor`` with ``max_workers``
+            threads is created, which on Python 2 requires the ``futures``
+            backport.
+        :param max_workers: Threads for the default executor.  Defaults to ``8``.
+        :type max_workers: ``int``
+        """
+        
+        if tissue.recorder is not None:
+            raise ValueError('AsyncTissue writes executions itself; use a Tissue without a recorder.')
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers)
+            self.owns_executor = True
+        else:
+            self.owns_executor = False
+        self.tissue = tissue
+        self.executor = executor
+        with tissue.session_transaction():
+            self.test_cycle_id = tissue.test_cycle.id
+            self.execution_batch_id = tissue.execution_batch.id
+        self.pending = set()
+        self._lock = Lock()
+    
+    def _submit(self, function, *args):
+        
+        future = self.executor.submit(function, *args)
+        with self._lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+    
+    def _done(self, future):
+        
+        with self._lock:
+            self.pending.discard(future)
+    
+    def _run_hooks(self, name, *args):
+        
+        for hook in self.tissue.hooks(name):
+            _wait_for(hook(*args))
+    
+    def _transaction(self, function, *args):
+        
+        session = self.tissue.session_factory()
+        try:
+            result = function(session, *args)
+            session.commit()
+            return result
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    def session_transaction(self, function, *args):
+        """Calls ``function(session, *args)`` in the executor with a session of
+        its own, committing it afterwards.
+        
+        :returns: A future of ``function``\ 's return value.
+        """
+        
+        return self._submit(self._transaction, function, *args)
+    
+    def _enter_case(self, session, case, test_address_parts, description, start_time):
+        
+        tissue = self.tissue
+        case = tissue.resolve_case(session, case, commit_new=True)
+        case_execution = tissue.add_case_execution(session, case, test_address_parts, description,
+                                                   start_time=start_time,
+                                                   execution_batch_id=self.execution_batch_id,
+                                                   test_cycle_id=self.test_cycle_id)
+        session.flush()
+        return case_execution.id
+    
+    def enter_case(self, case, test_address_parts, description=''):
+        """Enters a new :term:`Case Execution`\ .  Arguments are as for
+        ``Tissue.enter_case``\ .
+        
+        :returns: A future of the new execution's id.
+        """
+        
+        test_address_parts = list(test_address_parts)
+        start_time = datetime.now()
+        
+        def enter():
+            
+            self._run_hooks('before_enter_case', case, description)
+            execution_id = self._transaction(self._enter_case, case, test_address_parts,
+                                             description, start_time)
+            self._run_hooks('after_enter_case', case, description)
+            return execution_id
+        
+        return self._submit(enter)
+    
+    def _exit_case(self, session, execution_id, result, end_time):
+        
+        Execution = self.tissue.db_models['CaseExecution'].__table__
+        session.execute(Execution.update()
+                        .where(Execution.c.id==execution_id)
+                        .values(result=result, end_time=end_time))
+    
+    def exit_case(self, execution_id, result):
+        """Exits the :term:`Case Execution` with the id ``execution_id``\ ,
+        recording ``result``\ .
+        
+        :returns: A future that completes once the result is written.
+        """
+        
+        end_time = datetime.now()
+        
+        def exit_():
+            
+            self._run_hooks('before_exit_case', result)
+            self._transaction(self._exit_case, execution_id, result, end_time)
+            self._run_hooks('after_exit_case', result)
+        
+        return self._submit(exit_)
+    
+    def exit(self):
+        """Waits for every call still pending, then exits the Tissue.
+        
+        :returns: A future that completes once the Tissue has exited.
+        """
+        
+        with self._lock:
+            pending = list(self.pending)
+        
+        def exit_():
+            
+            for future in pending:
+                # Waits without raising; failures were reported to their callers
+                future.exception()
+            self.tissue.exit()
+        
+        future = self.executor.submit(exit_)
+        if self.owns_executor:
+            future.add_done_callback(lambda done: self.executor.shutdown(wait=False))
+        return future
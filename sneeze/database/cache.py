@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """A mapping that holds at most ``size`` items, discarding the least
+    recently used item when a new one is added to a full cache.  A ``size``
+    of ``0`` disables the cache.  Safe to share between threads.
+    """
+    
+    def __init__(self, size):
+        
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+    
+    def get(self, key, default=None):
+        
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+    
+    def __setitem__(self, key, value):
+        
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+    
+    def discard(self, key):
+        
+        with self.lock:
+            self.items.pop(key, None)
+    
+    def __contains__(self, key):
+        
+        return key in self.items
+    
+    def __len__(self):
+        
+        return len(self.items)
+    
+    def clear(self):
+        
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,121 @@
+'''Process-wide registry of ``SQLAlchemy`` engines, so that every
+:doc:`Tissue <tissue>` in a process that uses the same connection string and
+pool options shares one connection pool, along with metrics for those pools.
+'''
+
+
+from threading import Lock
+from weakref import WeakKeyDictionary
+from timeit import default_timer
+from sqlalchemy import create_engine, event
+import os
+
+
+_engines = {}
+_engines_lock = Lock()
+_pool_metrics = WeakKeyDictionary()
+
+
+class PoolMetrics(object):
+    """Counts connection checkouts from an engine's pool and the time spent
+    waiting for them.  The events are registered through the engine, so they
+    carry over to the new pool when the engine is disposed, and waits are
+    timed around the engine's connect methods rather than the pool's.
+    """
+    
+    def __init__(self, engine):
+        
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.connections = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = Lock()
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        # Before SQLAlchemy 1.4, sessions and Engine.execute connect through a
+        # contextual method rather than Engine.connect; 1.4 has none.  Only the
+        # first one found is timed, as the public one calls the private one
+        names = ['connect']
+        names.extend([name for name in ('_contextual_connect', 'contextual_connect')
+                      if hasattr(engine, name)][:1])
+        for name in names:
+            setattr(engine, name, self._timed(getattr(engine, name)))
+    
+    def _timed(self, connect):
+        
+        def timed_connect(*args, **kwargs):
+            
+            started = default_timer()
+            try:
+                return connect(*args, **kwargs)
+            finally:
+                self._record_wait(default_timer() - started)
+        
+        return timed_connect
+    
+    def _on_connect(self, dbapi_connection, connection_record):
+        
+        with self._lock:
+            self.connections += 1
+    
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+    
+    def _on_checkin(self, dbapi_connection, connection_record):
+        
+        with self._lock:
+            self.checked_out -= 1
+    
+    def _record_wait(self, wait):
+        
+        with self._lock:
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+    
+    def as_dict(self):
+        
+        with self._lock:
+            return {'checkouts' : self.checkouts,
+                    'checked_out' : self.checked_out,
+                    'peak_checked_out' : self.peak_checked_out,
+                    'connections' : self.connections,
+                    'total_wait' : self.total_wait,
+                    'max_wait' : self.max_wait,
+                    'mean_wait' : self.total_wait / self.checkouts if self.checkouts else 0.0}
+
+
+def get_engine(db_config_string, **engine_options):
+    """Returns the engine for ``db_config_string`` and ``engine_options``\ ,
+    creating it on first use in the current process.  Options are passed to
+    `SQLAlchemy's create_engine
+    <http://docs.sqlalchemy.org/en/rel_0_8/core/engines.html#sqlalchemy.create_engine>`_\ ;
+    options with a value of ``None`` are left at ``SQLAlchemy``\ 's defaults.
+    """
+    
+    engine_options = dict((name, value) for name, value in engine_options.iteritems()
+                          if value is not None)
+    key = (db_config_string, tuple(sorted(engine_options.items())))
+    with _engines_lock:
+        pid, engine = _engines.get(key, (None, None))
+        # A forked child must not use connections it inherited from its parent
+        if pid != os.getpid():
+            engine = create_engine(db_config_string, **engine_options)
+            _engines[key] = (os.getpid(), engine)
+    return engine
+
+
+def get_pool_metrics(engine):
+    """Returns the :class:`PoolMetrics` for ``engine``\ , attaching them on first use."""
+    
+    with _engines_lock:
+        metrics = _pool_metrics.get(engine)
+        if metrics is None:
+            metrics = _pool_metrics[engine] = PoolMetrics(engine)
+    return metrics
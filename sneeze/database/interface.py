@@ -1,10 +1,18 @@
-from threading import Lock
-from sqlalchemy import create_engine, or_
+from threading import Lock, local
+from weakref import WeakKeyDictionary
+from sqlalchemy import or_, select, func, event
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.util import identity_key
 from datetime import datetime
-import pkg_resources
-from sneeze.database.models import Base, EXECUTION_STATUSES, add_models
+from timeit import default_timer
+from sneeze.database.models import Base, EXECUTION_STATUSES, add_models, encode_address
+from sneeze.database.cache import LRUCache
+from sneeze.entry_points import iter_entry_points
+from sneeze.database.migrations import create_schema, check_version
+from sneeze.database.engines import get_engine, get_pool_metrics
+from sneeze.database.reruns import rerun_cycle_id
+from sneeze.database import spool
 
 
 class SessionTransaction(object):
@@ -18,16 +26,97 @@ class SessionTransaction(object):
         
         self.tissue.access_lock.acquire()
         self.session = self.tissue.make_session()[0]
+        self.tissue.context.transaction_session = self.session
         return self.session
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         
-        self.session.commit()
-        self.tissue.last_session = self.session
-        self.tissue.access_lock.release()
+        try:
+            if exc_type is None:
+                try:
+                    self.session.commit()
+                except:
+                    self.session.rollback()
+                    raise
+            else:
+                self.session.rollback()
+        finally:
+            self.tissue.context.transaction_session = None
+            self.tissue.last_session = self.session
+            self.tissue.access_lock.release()
+        return False
+
+
+class ContextSessionTransaction(SessionTransaction):
+    """The :class:`SessionTransaction` of ``Tissue``\ s with
+    ``concurrent_cases``\ .  Takes no lock; each thread gets a new session
+    per transaction, into which only its own ``case_execution`` is merged.
+    The session stays open until the thread's next transaction, as the
+    ``Tissue``\ 's ``last_session`` does.
+    """
+    
+    def __enter__(self):
+        
+        context = self.tissue.context
+        self.session = self.tissue.session_factory()
+        if context.case_execution is not None:
+            context.case_execution = self.session.merge(context.case_execution)
+        if context.session is not None:
+            context.session.close()
+        context.session = context.transaction_session = self.session
+        return self.session
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        
+        self.tissue.context.transaction_session = None
+        if exc_type is None:
+            try:
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+        else:
+            self.session.rollback()
         return False
 
 
+class _CaseContext(object):
+    
+    case_execution = None
+    session = None
+    transaction_session = None
+    pending_default_case = None
+
+
+class TimedSessionTransaction(SessionTransaction):
+    """A :class:`SessionTransaction` that adds the time spent waiting for the
+    ``Tissue``\ 's lock, and the time spent committing, to the ``Tissue``\ 's
+    ``timings``\ .
+    """
+    
+    def __enter__(self):
+        
+        timings = self.tissue.timings
+        started = default_timer()
+        self.tissue.access_lock.acquire()
+        timings.add('transaction_lock_wait', default_timer() - started)
+        try:
+            self.session = self.tissue.make_session()[0]
+        except:
+            self.tissue.access_lock.release()
+            raise
+        self.tissue.context.transaction_session = self.session
+        return self.session
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        
+        started = default_timer()
+        try:
+            return super(TimedSessionTransaction, self).__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.tissue.timings.add('transaction_commit', default_timer() - started)
+
+
 # Multiprocess support
 # TODO: Less hacky please...
 _db_models = {}
@@ -41,6 +130,21 @@ def _get_models(base, adders):
     return _db_models
 
 
+def load_models(declarative_base=Base):
+    """Returns the ``dict`` of Sneeze models, including models added by
+    plugins through the ``add_models`` entry point, derived from
+    ``declarative_base``\ .
+    """
+    
+    # To play nice with SQLAlchemy web framework integration, we have to wrap
+    # the models in functions that take a declarative base, so we call that function
+    # for the core Sneeze models here
+    adders = [add_models]
+    for ext_add_models in iter_entry_points('nose.plugins.sneeze.plugins.add_models'):
+        adders.append(ext_add_models.load())
+    return _get_models(declarative_base, adders)
+
+
 class Tissue(object):
     """The Tissue is the core component of Sneeze; it catches everything from
     your nose when you Sneeze.  The Tissue loads the DB models, manages the DB
@@ -51,15 +155,49 @@ class Tissue(object):
     :term:`Plugin Manager`\ s, and a dictionary of added db model classes.
     """
     
+    transaction_class = SessionTransaction
+    
+    @property
+    def context(self):
+        """The case state of the calling thread: with ``concurrent_cases``\ ,
+        the thread's own, or the one it was given by :meth:`bind`\ ; otherwise
+        the ``Tissue``\ 's.
+        """
+        
+        if self.thread_contexts is None:
+            return self.shared_context
+        try:
+            return self.thread_contexts.context
+        except AttributeError:
+            context = self.thread_contexts.context = _CaseContext()
+            return context
+    
+    @property
+    def case_execution(self):
+        
+        context = self.context
+        if context.pending_default_case is not None and self.recorder is None:
+            self.materialize_default_case()
+        return context.case_execution
+    
+    @case_execution.setter
+    def case_execution(self, case_execution):
+        
+        self.context.case_execution = case_execution
+    
     def __init__(self, db_config_string, test_cycle_name, test_cycle_description,
                  environment, host, command_line_arguments, start_time=None,
                  test_cycle_id=None, declarative_base=Base, engine=None,
-                 session_factory=None, rerun_execution_ids=[]):
+                 session_factory=None, rerun_execution_ids=[], recorder=None,
+                 long_lived_session=False, case_cache_size=10000, schema='create',
+                 engine_options=None, upload_to=None, timings=None, compact_addresses=False,
+                 concurrent_cases=False, bounded_memory=False, lazy_default_cases=False):
         """Initialize a Tissue object.  Creates a ``SQLAlchemy`` `engine
         <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
         and `session factory
         <http://docs.sqlalchemy.org/en/latest/orm/session.html#sqlalchemy.orm.session.sessionmaker>`_
-        , loads models from the plugin entry point, creates a new or
+        , loads models from the plugin entry point, prepares the database
+        schema, creates a new or
         establishes relationship to an existing :term:`Test Cycle`, and creates
         an :term:`Execution Batch`.  Also creates the ``access_lock`` for the
         Tissue instance.
@@ -92,7 +230,8 @@ class Tissue(object):
         :type declarative_base: `SQLAlchemy declarative base
             <http://docs.sqlalchemy.org/en/rel_0_8/orm/extensions/declarative.html>`_
         :param engine: Used to initialize the session factory.  If ``None`` is provided,
-            an engine is created using `SQLAlchemy's create_engine
+            the process-wide engine for ``db_config_string`` and ``engine_options``
+            is used, created on first use with `SQLAlchemy's create_engine
             <http://docs.sqlalchemy.org/en/rel_0_8/core/engines.html#sqlalchemy.create_engine>`_\ .
             Defaults to ``None``.
         :type engine: `SQLAlchemy engine
@@ -108,44 +247,128 @@ class Tissue(object):
             from.  The test names from the executions will be added to the list
             of test names to be run.  Defaults to an empty list.
         :type rerun_execution_ids: iterable of ``int``s.
+        :param recorder: If provided, case entries and exits are handed to the
+            recorder as events instead of being written to the database by the
+            calling thread.  See :class:`~sneeze.database.recorder.WriteBehindRecorder`\ .
+            Defaults to ``None``.
+        :type recorder: recorder object or ``None``
+        :param long_lived_session: If ``True``, a single session is kept open
+            for the life of the ``Tissue`` and reused by every
+            :meth:`session_transaction`\ , instead of creating a new session and
+            merging the ``Tissue``\ 's state into it each time.  Objects in the
+            session are not expired on commit.  Defaults to ``False``.
+        :type long_lived_session: ``bool``
+        :param case_cache_size: Number of :term:`Test Case` label to id mappings
+            to keep in memory, so that entering a case does not have to look the
+            label up in the database.  ``0`` disables the cache.  Defaults to
+            ``10000``.
+        :type case_cache_size: ``int``
+        :param schema: How the database schema is prepared.  ``'create'`` creates
+            any missing tables, and the current schema in an empty database; an
+            existing database whose schema is out of date raises
+            :class:`~sneeze.database.migrations.SchemaVersionError` until
+            ``sneeze-upgrade-db`` has been run on it.  ``'check'`` only checks the
+            recorded schema version with a single query, raising
+            :class:`~sneeze.database.migrations.SchemaVersionError` if it is out
+            of date.  ``'none'`` assumes the schema is current.  Defaults to
+            ``'create'``.
+        :type schema: ``string``
+        :param engine_options: Keyword arguments for ``create_engine``\ , such as
+            ``pool_size``\ , ``max_overflow``\ , ``pool_recycle`` and
+            ``pool_pre_ping``\ .  Ignored if ``engine`` is provided.  Defaults to
+            ``None``.
+        :type engine_options: ``dict`` or ``None``
+        :param upload_to: If the ``Tissue`` is recording to a spool (see
+            :mod:`sneeze.database.spool`\ ), the reporting database to upload the
+            spool to when the ``Tissue`` exits, as a connection string or engine.
+            Defaults to ``None``.
+        :type upload_to: string, `SQLAlchemy engine
+            <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+            or ``None``
+        :param timings: If given, :meth:`enter_case`\ , :meth:`exit_case`\ ,
+            :meth:`make_session`\ , session transactions and plugin hooks are
+            timed into it, and its summary is passed to the :meth:`report_timings`
+            plugin hook on :meth:`exit`\ .  Defaults to ``None``, which leaves them
+            untimed.
+        :type timings: :class:`sneeze.database.timings.Timings` or ``None``
+        :param compact_addresses: If ``True``, each distinct test address is
+            stored once, as an ``Address``\ , and referenced by the
+            :term:`Case Execution`\ s recorded with it, rather than being written
+            as one address part row per element for every execution.  Read
+            addresses through ``CaseExecution.test_address``\ , which handles
+            both forms.  Defaults to ``False``.
+        :type compact_addresses: ``bool``
+        :param concurrent_cases: If ``True``, ``case_execution`` is kept per
+            thread, so threads running tests in parallel each enter and exit
+            their own cases, and each transaction uses a session of its own
+            instead of taking the ``access_lock``\ .  Each thread enters the
+            :term:`Default Case` after exiting a case.  Threads started by a
+            test only see its execution if their target is wrapped with
+            :meth:`bind`\ .  Cannot be combined with a ``recorder`` or
+            ``long_lived_session``\ .  Defaults to ``False``.
+        :type concurrent_cases: ``bool``
+        :param bounded_memory: If ``True``, each completed :term:`Case Execution`
+            is expunged from the session, together with the address parts and
+            :term:`Test Cycle` links loaded with it, when the next case is
+            entered, so that a long run, particularly with a
+            ``long_lived_session``\ , holds only the current execution, the
+            shared instances and the id caches.  Memory then stays bounded by
+            ``case_cache_size``\ , though an in-memory SQLite database still
+            grows with what is recorded in it.  Defaults to ``False``.
+        :type bounded_memory: ``bool``
+        :param lazy_default_cases: If ``True``, entering the :term:`Default Case`
+            writes nothing.  Its :term:`Case Execution` is only created, with
+            the time the gap between tests began as its start time, if
+            ``case_execution`` is read before the next case is entered, which is
+            how :term:`Plugin Manager`\ s record activity against it.  Gaps
+            with no activity are not recorded at all.  Defaults to ``False``.
+        :type lazy_default_cases: ``bool``
         """
         
+        if concurrent_cases and (recorder is not None or long_lived_session):
+            raise ValueError('concurrent_cases cannot be combined with a recorder '
+                             'or a long lived session.')
         self.access_lock = Lock()
         self.access_lock.acquire()
+        self.concurrent_cases = concurrent_cases
+        self.bounded_memory = bounded_memory
+        self.lazy_default_cases = lazy_default_cases
+        self.shared_context = _CaseContext()
+        self.thread_contexts = local() if concurrent_cases else None
+        # Ids of the open execution of each thread's context, for exit to close.
+        # Keyed by context rather than thread, as a new thread may reuse the
+        # ident of one that has ended
+        self.open_executions = {}
         if engine is None:
-            engine = create_engine(db_config_string)
-        else:
-            engine = engine
-        # To play nice with SQLAlchemy web framework integration, we have to wrap
-        # the models in functions that take a declarative base, so we call that function
-        # for the core Sneeze models here
-        adders = [add_models]
-        for ext_add_models in pkg_resources.iter_entry_points(group='nose.plugins.sneeze.plugins.add_models'):
-            adders.append(ext_add_models.load())
-        self.db_models = _get_models(declarative_base, adders)
+            engine = get_engine(db_config_string, **(engine_options or {}))
+        self.pool_metrics = get_pool_metrics(engine)
+        self.engine = engine
+        self.upload_to = upload_to
+        self.db_models = load_models(declarative_base)
         self.plugin_managers = []
-        declarative_base.metadata.create_all(engine)
+        self.hook_table = {}
+        self.schema = schema
+        self.declarative_base = declarative_base
+        self.prepare_schema(engine)
         if session_factory is None:
             self.session_factory = sessionmaker(bind=engine)
         else:
             self.session_factory = session_factory
         session = self.session_factory()
+        if long_lived_session:
+            session.expire_on_commit = False
+        self.long_lived_session = long_lived_session
+        self.case_cache = LRUCache(case_cache_size)
+        # Held while a thread sharing the Tissue adds a case, see add_case
+        self.case_lock = Lock()
+        # Cache entries for rows added in a session's open transaction
+        self.uncommitted_cache_entries = WeakKeyDictionary()
+        self.uncommitted_cache_lock = Lock()
+        self.compact_addresses = compact_addresses
+        self.address_cache = LRUCache(case_cache_size if compact_addresses else 0)
         TestCycle = self.db_models['TestCycle']
-        CaseExecution = self.db_models['CaseExecution']
         if rerun_execution_ids and not test_cycle_id and not test_cycle_name:
-            case_executions = (session.query(CaseExecution)
-                               .filter(CaseExecution.id.in_(rerun_execution_ids))
-                               .all())
-            if case_executions[0].test_cycles:
-                cycle_ids = set(cycle.id for cycle in case_executions[0].test_cycles)
-                for case_execution in case_executions[1:]:
-                    if case_execution.test_cycles:
-                        cycle_ids.intersection_update(cycle.id for cycle in case_execution.test_cycles)
-                    else:
-                        break
-                else:
-                    if len(cycle_ids) == 1:
-                        test_cycle_id = cycle_ids.pop()
+            test_cycle_id = rerun_cycle_id(session, self.db_models, rerun_execution_ids)
         if test_cycle_id:
             self.test_cycle = session.query(TestCycle).filter(TestCycle.id==test_cycle_id).one()
             session.commit()
@@ -157,16 +380,183 @@ class Tissue(object):
                                                         start_time=start_time if start_time else datetime.now())
         session.add(self.execution_batch)
         session.commit()
+        if concurrent_cases:
+            # Load the shared instances once and detach them, so that threads
+            # only ever read them
+            session.refresh(self.test_cycle)
+            session.refresh(self.execution_batch)
+            self.transaction_class = ContextSessionTransaction
+            session.close()
         self.last_session = session
+        self.recorder = recorder
         self.case_execution = None
+        self.timings = timings
+        if timings is not None:
+            self.time_methods()
         self.access_lock.release()
     
+    def time_methods(self):
+        """Replaces this ``Tissue``\ 's case event, session and transaction
+        methods with versions timed into ``timings``\ .  The :meth:`enter_case`
+        timings include entering the :term:`Default Case` after each test, and
+        since :meth:`exit_case` enters it, the :meth:`exit_case` timings do too.
+        """
+        
+        for name in ('enter_case', 'exit_case', 'make_session'):
+            setattr(self, name, self.timings.timed(name, getattr(self, name)))
+        if not self.concurrent_cases:
+            # Concurrent case transactions take no lock to time
+            self.transaction_class = TimedSessionTransaction
+        self.hook_table = {}
+    
     def start(self):
         """Called to begin the :term:`Execution Batch` being run in this
-        ``Tissue``, enters the batch's :term:`Default Case`.
+        ``Tissue``, enters the batch's :term:`Default Case`.  Starts the
+        ``recorder``\ , if there is one.
+        """
+        
+        if self.recorder is not None:
+            self.recorder.start(self)
+        self.enter_default_case()
+    
+    def enter_default_case(self):
+        """Enters the :term:`Default Case` of the ``Tissue``\ 's
+        :term:`Execution Batch`\ , or defers it with ``lazy_default_cases``\ .
+        """
+        
+        if self.lazy_default_cases:
+            self.defer_default_case()
+        else:
+            self.enter_case(self.execution_batch.default_case_id, ['default_case'])
+    
+    def defer_default_case(self):
+        """Enters the :term:`Default Case` without writing its
+        :term:`Case Execution`\ , which :meth:`materialize_default_case`
+        creates if it is needed.  Calls the :meth:`before_enter_case` and
+        :meth:`after_enter_case` plugin hooks with the :term:`Default Case`\ 's
+        id, as a recorder would.
+        """
+        
+        case = self.execution_batch.default_case_id if self.execution_batch is not None else None
+        for hook in self.hooks('before_enter_case'):
+            hook(case, '')
+        self.context.pending_default_case = datetime.now()
+        for hook in self.hooks('after_enter_case'):
+            hook(case, '')
+    
+    def materialize_default_case(self):
+        """Creates the :term:`Case Execution` of a deferred :term:`Default Case`
+        as the current ``case_execution``\ , in the session of the calling
+        thread's transaction if it is in one, or in a transaction of its own.
+        """
+        
+        context = self.context
+        start_time, context.pending_default_case = context.pending_default_case, None
+        
+        def add(session):
+            
+            case = self.resolve_case(session, self.execution_batch.default_case_id)
+            context.case_execution = self.add_case_execution(session, case, ['default_case'],
+                                                             start_time=start_time)
+            if self.concurrent_cases:
+                session.flush()
+                self.open_executions[context] = context.case_execution.id
+        
+        if context.transaction_session is not None:
+            add(context.transaction_session)
+        else:
+            with self.session_transaction() as session:
+                add(session)
+    
+    def bind(self, function):
+        """Returns a function that calls ``function`` with the calling thread's
+        current :term:`Case Execution` as its ``case_execution``\ .  With
+        ``concurrent_cases``\ , wrap the target of any thread a test starts,
+        so that plugin activity in that thread is recorded against the test::
+            
+            Thread(target=tissue.bind(poll_service)).start()
+        
+        The thread gets a context and sessions of its own, starting from the
+        execution that was current when ``bind`` was called.  Without
+        ``concurrent_cases`` every thread already shares the ``Tissue``\ 's
+        state, and ``function`` is returned as it is.
+        
+        :param function: The function the thread will run.
+        :type function: callable
         """
         
-        self.enter_case(self.execution_batch.default_case.id, ['default_case'])
+        if self.thread_contexts is None:
+            return function
+        thread_contexts = self.thread_contexts
+        # Only the id crosses threads; the execution itself belongs to a
+        # session of the calling thread
+        case_execution = self.case_execution
+        case_execution_id = case_execution.id if case_execution is not None else None
+        
+        def bound(*args, **kwargs):
+            
+            previous = getattr(thread_contexts, 'context', None)
+            context = thread_contexts.context = _CaseContext()
+            try:
+                if case_execution_id is not None:
+                    context.session = self.session_factory()
+                    context.case_execution = (context.session.query(self.db_models['CaseExecution'])
+                                              .get(case_execution_id))
+                    context.session.commit()
+                return function(*args, **kwargs)
+            finally:
+                if context.session is not None:
+                    context.session.close()
+                if previous is None:
+                    del thread_contexts.context
+                else:
+                    thread_contexts.context = previous
+        
+        return bound
+    
+    def add_plugin_manager(self, manager):
+        """Attaches a plugin manager to the ``Tissue``\ .  Plugin managers should
+        be attached with this method rather than by appending to
+        ``plugin_managers``\ , so that the hook dispatch lists are rebuilt.
+        
+        :param manager: The plugin manager.
+        """
+        
+        self.plugin_managers.append(manager)
+        self.hook_table = {}
+    
+    def hooks(self, name):
+        """Returns the bound ``name`` methods of the attached plugin managers
+        that define it, in the order the managers were attached.  The list is
+        built on first use and kept until another manager is attached.
+        
+        :param name: Name of the hook, e.g. ``'after_exit_case'``\ .
+        :type name: ``string``
+        
+        :returns: A ``list`` of bound methods.
+        """
+        
+        try:
+            return self.hook_table[name]
+        except KeyError:
+            methods = self.hook_table[name] = [getattr(manager, name)
+                                               for manager in self.plugin_managers
+                                               if hasattr(manager, name)]
+            if self.timings is not None:
+                methods[:] = [self.timings.timed('%s.%s' % (type(method.__self__).__name__, name),
+                                                 method)
+                              for method in methods]
+            return methods
+    
+    def prepare_schema(self, engine):
+        """Prepares the schema of the database behind ``engine`` as the ``schema``
+        argument describes.
+        """
+        
+        if self.schema == 'create':
+            create_schema(engine, self.declarative_base)
+        elif self.schema == 'check':
+            check_version(engine)
     
     def make_session(self, sync_with_new=True):
         """Wraps the ``SQLAlchemy`` session factory for the ``Tissue``
@@ -181,14 +571,23 @@ class Tissue(object):
         :returns: A 2-tuple containing the newly created session and a ``dict``
             containing the merge target (ex ``test_cycle`` and
             ``execution_batch``\ ) model instances from the newly created
-            session.
+            session.  If the ``Tissue`` uses a long lived session, that session
+            and the ``Tissue``\ 's own instances are returned instead.
         """
         
+        # Read through the context, so as not to materialize a deferred default case
+        case_execution = self.context.case_execution
+        if self.long_lived_session:
+            merge_targets = {'test_cycle' : self.test_cycle,
+                             'execution_batch' : self.execution_batch}
+            if case_execution:
+                merge_targets['case_execution'] = case_execution
+            return self.last_session, merge_targets
         session = self.session_factory()
         merge_targets = {'test_cycle' : session.merge(self.test_cycle),
                          'execution_batch' : session.merge(self.execution_batch)}
-        if self.case_execution:
-            merge_targets['case_execution'] = session.merge(self.case_execution)
+        if case_execution:
+            merge_targets['case_execution'] = session.merge(case_execution)
         # TODO: Plugin hook to allow extension of session state replication here
         if sync_with_new:
             # TODO: Plugin hook to override sync behavior for session state replication here
@@ -202,7 +601,289 @@ class Tissue(object):
         lock and committing the session automatically.
         """
         
-        return SessionTransaction(self)
+        return self.transaction_class(self)
+    
+    def summary(self, include_default_cases=False):
+        """Counts the :term:`Case Execution`\ s in the ``Tissue``\ 's
+        :term:`Test Cycle` and :term:`Execution Batch` by result, with a
+        single query.
+        
+        :param include_default_cases: If ``True``, executions of
+            :term:`Default Case`\ s are counted too.  Defaults to ``False``.
+        :type include_default_cases: ``bool``
+        
+        :returns: A ``dict`` with ``'test_cycle'`` and ``'execution_batch'``
+            keys, each holding a ``dict`` of counts keyed by the names in
+            ``sneeze.database.models.SUMMARY_FIELDS``\ .
+        """
+        
+        with self.session_transaction() as session:
+            test_cycle, execution_batch = self.db_models['TestCycle'].summary_with_batch(
+                session, self.test_cycle.id, self.execution_batch.id, include_default_cases)
+            return {'test_cycle' : test_cycle, 'execution_batch' : execution_batch}
+    
+    def resolve_case(self, session, case, commit_new=False):
+        """Finds the :term:`Test Case` for ``case`` in ``session``\ , creating
+        a new one if no existing case matches.  A label whose id is in the case
+        cache is not looked up: unless the case is already in ``session``\ , a
+        ``Case`` carrying the cached id and the label, not attached to any
+        session, is returned.
+        
+        :param session: The session to look the case up in.
+        :type session: ``SQLAlchemy Session``
+        :param case: A :term:`Test Case` object, id, or label.
+        :type case: ``TestCase`` DB model object, ``int`` or ``string``
+        :param commit_new: If ``True``, a label that is not cached is resolved
+            with :meth:`add_case` rather than in ``session``\ , for threads
+            that share the ``Tissue``\ .  Defaults to ``False``.
+        :type commit_new: ``bool``
+        
+        :returns: A ``TestCase`` DB model object.
+        """
+        
+        Case = self.db_models['Case']
+        if isinstance(case, Case):
+            return case
+        try:
+            case_id = int(case)
+        except ValueError:
+            pass
+        else:
+            found = session.query(Case).get(case_id)
+            return found if found is not None else Case(label=case)
+        case_id = self.case_cache.get(case)
+        if case_id is None and commit_new:
+            case_id = self.add_case(case)
+        if case_id is not None:
+            # Only the id is needed to record an execution; a query here would
+            # cost a round trip per test
+            found = session.identity_map.get(identity_key(Case, case_id))
+            if found is None:
+                found = Case(label=case)
+                found.id = case_id
+            return found
+        # Labels are not unique; writers in other processes may both have added a case
+        found = session.query(Case).filter(Case.label==case).order_by(Case.id).first()
+        if found is None:
+            found = Case(label=case)
+            session.add(found)
+            session.flush()
+        self.cache_on_commit(session, self.case_cache, case, found.id)
+        return found
+    
+    def add_case(self, label):
+        """Returns the id of the :term:`Test Case` labelled ``label``\ , adding
+        it in a short transaction of its own if there is none.  Threads
+        recording through one ``Tissue`` add cases one at a time, each checking
+        the case cache first, so that a label is added once however many of
+        them miss the cache together.
+        
+        :param label: The label of the :term:`Test Case`\ .
+        :type label: ``string``
+        
+        :returns: The ``int`` id of the :term:`Test Case`\ .
+        """
+        
+        Case = self.db_models['Case']
+        with self.case_lock:
+            case_id = self.case_cache.get(label)
+            if case_id is not None:
+                return case_id
+            session = self.session_factory()
+            try:
+                found = session.query(Case.id).filter(Case.label==label).order_by(Case.id).first()
+                if found is None:
+                    case = Case(label=label)
+                    session.add(case)
+                    session.flush()
+                    case_id = case.id
+                    session.commit()
+                else:
+                    case_id = found[0]
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+            self.case_cache[label] = case_id
+            return case_id
+    
+    def cache_on_commit(self, session, cache, key, value):
+        """Stores ``value`` under ``key`` in ``cache`` once the transaction of
+        ``session`` commits, and forgets it if the transaction rolls back, so
+        that an id cache never holds the id of a row that was not saved.
+        
+        :param session: The session the row was read or added in.
+        :type session: ``SQLAlchemy Session``
+        :param cache: The cache to store the value in.
+        :type cache: :class:`~sneeze.database.cache.LRUCache`
+        """
+        
+        with self.uncommitted_cache_lock:
+            entries = self.uncommitted_cache_entries.get(session)
+            if entries is None:
+                entries = self.uncommitted_cache_entries[session] = []
+                event.listen(session, 'after_commit', self._store_cache_entries)
+                event.listen(session, 'after_rollback', self._discard_cache_entries)
+            entries.append((cache, key, value))
+    
+    def _take_cache_entries(self, session):
+        
+        with self.uncommitted_cache_lock:
+            entries = self.uncommitted_cache_entries.get(session, [])
+            taken = list(entries)
+            # The listeners stay for the session's next transaction
+            del entries[:]
+        return taken
+    
+    def _store_cache_entries(self, session):
+        
+        for cache, key, value in self._take_cache_entries(session):
+            cache[key] = value
+    
+    def _discard_cache_entries(self, session):
+        
+        self._take_cache_entries(session)
+    
+    def preload_cases(self, labels, chunk_size=500):
+        """Loads the ids of the :term:`Test Case`\ s with the given labels into
+        the ``Tissue``\ 's case cache, using one query per ``chunk_size``
+        labels.
+        
+        :param labels: The labels of the :term:`Test Case`\ s about to be run.
+        :type labels: iterable of ``string``\ s
+        :param chunk_size: Maximum number of labels per query.  Defaults to ``500``.
+        :type chunk_size: ``int``
+        """
+        
+        Case = self.db_models['Case']
+        labels = list(set(labels))
+        with self.session_transaction() as session:
+            for start in xrange(0, len(labels), chunk_size):
+                query = (session.query(Case.label, Case.id)
+                         .filter(Case.label.in_(labels[start:start + chunk_size])))
+                for label, case_id in query:
+                    self.case_cache[label] = case_id
+    
+    def address_ids(self, session, addresses, chunk_size=500):
+        """Returns the ids of the stored ``Address``\ es for the given test
+        addresses, inserting the ones not stored yet.  Ids are cached like
+        :term:`Test Case` ids, and the rest are looked up by digest with one
+        query per ``chunk_size`` addresses.
+        
+        :param session: The session to query and insert with.
+        :type session: ``SQLAlchemy Session``
+        :param addresses: Test addresses.
+        :type addresses: iterable of ``tuple``\ s of ``string``\ s
+        :param chunk_size: Maximum number of digests per query.  Defaults to ``500``.
+        :type chunk_size: ``int``
+        
+        :returns: A ``dict`` mapping each address ``tuple`` to its ``Address`` id.
+        """
+        
+        Address = self.db_models['Address'].__table__
+        ids = {}
+        missing = {}
+        for address in addresses:
+            address = tuple(address)
+            id_ = self.address_cache.get(address)
+            if id_ is None:
+                encoded, digest = encode_address(address)
+                missing[digest] = (address, encoded)
+            else:
+                ids[address] = id_
+        
+        def load_digests():
+            
+            digests = list(missing)
+            for start in xrange(0, len(digests), chunk_size):
+                query = (select([Address.c.digest, func.min(Address.c.id)])
+                         .where(Address.c.digest.in_(digests[start:start + chunk_size]))
+                         .group_by(Address.c.digest))
+                for digest, id_ in session.execute(query).fetchall():
+                    address = missing.pop(digest)[0]
+                    ids[address] = id_
+                    self.cache_on_commit(session, self.address_cache, address, id_)
+        
+        if missing:
+            load_digests()
+        if missing:
+            session.execute(Address.insert(), [{'digest' : digest, 'parts' : encoded}
+                                               for digest, (address, encoded) in missing.iteritems()])
+            load_digests()
+        return ids
+    
+    def add_case_execution(self, session, case, test_address_parts, description='',
+                           start_time=None, execution_batch_id=None, test_cycle_id=None):
+        """Creates a :term:`Case Execution` of ``case`` in the ``Tissue``\ 's
+        :term:`Execution Batch` and :term:`Test Cycle`\ .
+        
+        :param session: The session the ``Tissue``\ 's state was merged into.
+        :type session: ``SQLAlchemy Session``
+        :param case: The :term:`Test Case` being executed.
+        :type case: ``TestCase`` DB model object
+        :param test_address_parts: Will be recorded as the test address for the
+            :term:`Case Execution`\ .
+        :type test_address_parts: iterable of ``string``\ s
+        :param description: A description of the :term:`Test Case`\ .
+        :type description: ``string``
+        :param start_time: The start time of the :term:`Case Execution`\ .  If
+            ``None``, will be set to ``now()``\ .
+        :type start_time: ``datetime.datetime`` or ``None``
+        :param execution_batch_id: The id of the :term:`Execution Batch` to add
+            the execution to.  If ``None``, the ``Tissue``\ 's own batch is used.
+        :type execution_batch_id: ``int`` or ``None``
+        :param test_cycle_id: The id of the :term:`Test Cycle` to link the
+            execution to.  If ``None``, the ``Tissue``\ 's own cycle is used.
+        :type test_cycle_id: ``int`` or ``None``
+        
+        :returns: The new ``CaseExecution`` DB model object.
+        """
+        
+        # Link by primary key where possible; appending through the relationships
+        # would load every existing execution of the batch, cycle and case
+        if execution_batch_id is None:
+            execution_batch_id = self.execution_batch.id
+        if test_cycle_id is None:
+            test_cycle_id = self.test_cycle.id
+        case_execution = self.db_models['CaseExecution'](execution_batch=execution_batch_id,
+                                                         description=description,
+                                                         start_time=start_time)
+        if case.id is None:
+            case_execution.case = case
+        else:
+            case_execution.case_id = case.id
+        self.db_models['TestCycleCaseExecution'](test_cycle=test_cycle_id,
+                                                 case_execution=case_execution)
+        if self.compact_addresses:
+            test_address_parts = tuple(test_address_parts)
+            case_execution.address_id = self.address_ids(session, [test_address_parts])[test_address_parts]
+        else:
+            AddressPart = self.db_models['CaseExecutionAddressPart']
+            for part in test_address_parts:
+                case_execution.address_parts.append(AddressPart(part=part))
+        session.add(case_execution)
+        return case_execution
+    
+    def release_case_execution(self, session, case_execution):
+        """Expunges a completed :term:`Case Execution` from ``session``\ ,
+        along with the address parts and :term:`Test Cycle` links already loaded
+        with it, so that the session no longer references them.  Relationships
+        that were not loaded are left unloaded.  Pending changes to the
+        expunged instances are discarded, so ``session`` should be flushed
+        first.
+        
+        :param session: The session holding the execution.
+        :type session: ``SQLAlchemy Session``
+        :param case_execution: The completed execution.
+        :type case_execution: ``CaseExecution`` DB model object
+        """
+        
+        loaded = instance_state(case_execution).dict
+        for instance in (loaded.get('address_parts', []) + loaded.get('test_cycle_associations', [])
+                         + [case_execution]):
+            if instance in session:
+                session.expunge(instance)
     
     def enter_case(self, case, test_address_parts, description=''):
         """Causes the ``Tissue`` to enter a new :term:`Case Execution` for the
@@ -212,8 +893,10 @@ class Tissue(object):
         :meth:`enter_case`, unlike :meth:`exit_case`, is called for executions of the
         :term:`Default Case`\ .
         
-        :param case: A :term:`Test Case` object.
-        :type case: ``TestCase`` DB model object
+        :param case: A :term:`Test Case` object, id, or label.  When a ``recorder``
+            is in use, the :meth:`after_enter_case` hook receives ``case`` as it was
+            passed in, since the case is looked up later by the recorder.
+        :type case: ``TestCase`` DB model object, ``int`` or ``string``
         :param test_address_parts: Will be recorded as the test address for the
             :term:`Test Execution`.  Primarily useful for ``rerun_execution_ids``\ .
         :type test_address_parts: iterable of ``string``\ s
@@ -222,35 +905,34 @@ class Tissue(object):
         :type description: ``string``
         """
         
-        for manager in self.plugin_managers:
-            if hasattr(manager, 'before_enter_case'):
-                manager.before_enter_case(case, description)
-        with self.session_transaction() as session:
-            # Assumes no nested default case scopes; all default case executions
-            # should end PASSED (or PENDING)
-            if (self.case_execution and self.execution_batch
-                and self.case_execution.case.id == self.execution_batch.default_case.id):
-                self.case_execution.end_time = datetime.now()
-                self.case_execution.result = 'PASS'
-            Case = self.db_models['Case']
-            if not isinstance(case, Case):
-                try:
-                    condition = Case.id==int(case)
-                except ValueError:
-                    condition = Case.label==case
-                try:
-                    case = session.query(Case).filter(condition).one()
-                except NoResultFound:
-                    case = Case(label=case)
-            self.case_execution = self.db_models['CaseExecution'](case=case, description=description)
-            self.execution_batch.case_executions.append(self.case_execution)
-            self.test_cycle.case_executions.append(self.case_execution)
-            AddressPart = self.db_models['CaseExecutionAddressPart']
-            for part in test_address_parts:
-                self.case_execution.address_parts.append(AddressPart(part=part))
-        for manager in self.plugin_managers:
-            if hasattr(manager, 'after_enter_case'):
-                manager.after_enter_case(case, description)
+        for hook in self.hooks('before_enter_case'):
+            hook(case, description)
+        # A deferred default case that nothing was recorded against ends unwritten
+        self.context.pending_default_case = None
+        if self.recorder is not None:
+            self.recorder.put(('enter_case', case, list(test_address_parts), description,
+                               datetime.now()))
+        else:
+            with self.session_transaction() as session:
+                # Assumes no nested default case scopes; all default case executions
+                # should end PASSED (or PENDING).  Whether exited or closed here,
+                # the previous execution is complete
+                completed = self.context.case_execution
+                if (completed and self.execution_batch
+                    and completed.case_id == self.execution_batch.default_case_id):
+                    completed.end_time = datetime.now()
+                    completed.result = 'PASS'
+                case = self.resolve_case(session, case, commit_new=self.concurrent_cases)
+                self.case_execution = self.add_case_execution(session, case, test_address_parts,
+                                                              description)
+                if self.concurrent_cases or (self.bounded_memory and completed is not None):
+                    session.flush()
+                if self.concurrent_cases:
+                    self.open_executions[self.context] = self.case_execution.id
+                if self.bounded_memory and completed is not None:
+                    self.release_case_execution(session, completed)
+        for hook in self.hooks('after_enter_case'):
+            hook(case, description)
         
     
     def exit_case(self, result):
@@ -264,30 +946,124 @@ class Tissue(object):
         :type result: ``string``
         """
         
-        for manager in self.plugin_managers:
-            if hasattr(manager, 'before_exit_case'):
-                manager.before_exit_case(result)
-        with self.session_transaction():
-            self.case_execution.end_time = datetime.now()
-            self.case_execution.result = result
+        for hook in self.hooks('before_exit_case'):
+            hook(result)
+        if self.recorder is not None:
+            self.recorder.put(('exit_case', result, datetime.now()))
+        else:
+            with self.session_transaction():
+                self.case_execution.end_time = datetime.now()
+                self.case_execution.result = result
         # Very slim potential for activities to occur outside the start/end time
         # of any case execution here; if a thread grabs the lock between
         # the session transaction context and the enter case
-        for manager in self.plugin_managers:
-            if hasattr(manager, 'after_exit_case'):
-                manager.after_exit_case(result)
-        self.enter_case(self.execution_batch.default_case.id, ['default_case'])
+        for hook in self.hooks('after_exit_case'):
+            hook(result)
+        self.enter_default_case()
     
     def exit(self):
         """Called after the :term:`Execution Batch` is completed.  Tears down
         the ``Tissue``.  Closes out the last :term:`Default Case` execution
-        and calls the :meth:`exit_test_cycle` plugin hook.
+        and calls the :meth:`report_pool_metrics` and :meth:`exit_test_cycle`
+        plugin hooks.  If a ``recorder`` is in use, waits for it to finish
+        writing all queued events.  Finally, uploads the spool if ``upload_to``
+        was given.
         """
         
-        with self.session_transaction():
-            self.case_execution.result = 'PASS'
-            self.case_execution.end_time = datetime.now()
-            self.execution_batch.end_time = datetime.now()
-        for manager in self.plugin_managers:
-            if hasattr(manager, 'exit_test_cycle'):
-                manager.exit_test_cycle()
\ No newline at end of file
+        if self.recorder is not None:
+            self.recorder.put(('exit', datetime.now()))
+            self.recorder.close()
+        elif self.concurrent_cases:
+            CaseExecution = self.db_models['CaseExecution'].__table__
+            with self.session_transaction() as session:
+                if self.open_executions:
+                    # Only default case executions are closed; tests still
+                    # running in other threads are left PENDING
+                    session.execute(CaseExecution.update()
+                                    .where(CaseExecution.c.id.in_(self.open_executions.values()))
+                                    .where(CaseExecution.c.case_id==self.execution_batch.default_case_id)
+                                    .where(CaseExecution.c.end_time==None)
+                                    .values(result='PASS', end_time=datetime.now()))
+                session.merge(self.execution_batch).end_time = datetime.now()
+        else:
+            self.context.pending_default_case = None
+            with self.session_transaction():
+                # With lazy_default_cases, this may be the last test, already exited
+                case_execution = self.context.case_execution
+                if case_execution is not None and case_execution.end_time is None:
+                    case_execution.result = 'PASS'
+                    case_execution.end_time = datetime.now()
+                self.execution_batch.end_time = datetime.now()
+        if self.pool_metrics is not None:
+            pool_metrics = self.pool_metrics.as_dict()
+            for hook in self.hooks('report_pool_metrics'):
+                hook(pool_metrics)
+        for hook in self.hooks('exit_test_cycle'):
+            hook()
+        if self.timings is not None:
+            timings = self.timings.as_dict()
+            for hook in self.hooks('report_timings'):
+                hook(timings)
+        if self.upload_to is not None:
+            target = self.upload_to
+            if isinstance(target, basestring):
+                target = get_engine(target)
+            self.prepare_schema(target)
+            spool.upload(self.engine, target, self.declarative_base)
+
+
+class WorkerTissue(Tissue):
+    """A ``Tissue`` for multiprocess workers whose case events are written by
+    a :class:`~sneeze.database.recorder.WorkerAggregator` in the parent
+    process.  It never connects to the database, so the worker's
+    :term:`Plugin Manager`\ s cannot use :meth:`session_transaction`\ , and
+    ``test_cycle``\ , ``execution_batch`` and ``case_execution`` are ``None``\ .
+    """
+    
+    def __init__(self, recorder, declarative_base=Base, lazy_default_cases=False):
+        """
+        :param recorder: The recorder that sends events to the parent process.
+        :type recorder: :class:`~sneeze.database.recorder.WorkerRecorder`
+        :param declarative_base: Will be used to derive the models being added.
+        :type declarative_base: `SQLAlchemy declarative base
+            <http://docs.sqlalchemy.org/en/rel_0_8/orm/extensions/declarative.html>`_
+        :param lazy_default_cases: If ``True``, entering the :term:`Default Case`
+            sends no event, so the parent records no execution of it.  See
+            :class:`Tissue`\ .  Defaults to ``False``.
+        :type lazy_default_cases: ``bool``
+        """
+        
+        self.access_lock = Lock()
+        self.concurrent_cases = False
+        self.lazy_default_cases = lazy_default_cases
+        self.shared_context = _CaseContext()
+        self.thread_contexts = None
+        self.db_models = load_models(declarative_base)
+        self.plugin_managers = []
+        self.hook_table = {}
+        self.recorder = recorder
+        self.pool_metrics = None
+        self.upload_to = None
+        self.timings = None
+        self.compact_addresses = False
+        self.test_cycle = None
+        self.execution_batch = None
+        self.case_execution = None
+    
+    def enter_default_case(self):
+        
+        if self.lazy_default_cases:
+            self.defer_default_case()
+        else:
+            # The aggregator knows which batch, and so which default case, is this worker's
+            self.enter_case(None, ['default_case'])
+    
+    def session_transaction(self):
+        
+        raise RuntimeError('Worker Tissues have no database session; '
+                           'case events are written by the parent process.')
+    
+    def summary(self, include_default_cases=False):
+        
+        raise RuntimeError('Worker Tissues have no database session; '
+                           'case events are written by the parent process.')
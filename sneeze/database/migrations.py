@@ -0,0 +1,211 @@
+'''Versioned schema changes for existing Sneeze databases.  New databases get
+the current schema from ``create_all`` when a :doc:`Tissue <tissue>` starts;
+databases created by older versions of Sneeze, or missing tables for newly
+installed plugins, can be brought up to date with::
+    
+    sneeze-upgrade-db CONFIG_STRING
+
+The version applied to a database is recorded in the ``sneeze_schema_version``
+table, so that a Tissue that only needs to know the schema is current can
+check it with a single query.
+'''
+
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime, create_engine,
+                        inspect, select, func)
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import DBAPIError
+from datetime import datetime
+from sneeze.database.models import Base
+import sys, logging
+
+
+log = logging.getLogger(__name__)
+
+
+class SchemaVersionError(Exception):
+    
+    pass
+
+
+_version_metadata = MetaData()
+
+schema_version = Table('sneeze_schema_version', _version_metadata,
+                       Column('version', Integer, primary_key=True),
+                       Column('description', String(200)),
+                       Column('applied', DateTime))
+
+
+def create_missing_indexes(connection, metadata):
+    """Creates every index declared on the tables in ``metadata`` that does not
+    exist in the database yet.  An existing index on the same columns counts,
+    whatever its name, such as the one MySQL creates for each foreign key.
+    """
+    
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = inspector.get_indexes(table.name)
+        names = set(index['name'] for index in existing)
+        columns = set(tuple(index['column_names']) for index in existing)
+        for index in table.indexes:
+            if (index.name not in names and
+                    tuple(column.name for column in index.columns) not in columns):
+                log.info('Creating index %s on %s.', index.name, table.name)
+                index.create(connection)
+
+
+def add_missing_columns(connection, metadata):
+    """Creates every table in ``metadata`` that does not exist in the database
+    yet, adds the columns missing from the tables that do, and creates their
+    indexes.  Added columns must be nullable.
+    """
+    
+    metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                log.info('Adding column %s to %s.', column.name, table.name)
+                connection.execute('ALTER TABLE %s ADD COLUMN %s'
+                                   % (table.name, CreateColumn(column).compile(dialect=connection.dialect)))
+    create_missing_indexes(connection, metadata)
+
+
+# Append only; each entry is (version, description, callable taking a connection
+# and the declarative base's metadata)
+MIGRATIONS = [(1, 'Index foreign keys and case labels', create_missing_indexes),
+              (2, 'Add compact test addresses', add_missing_columns)]
+
+CURRENT_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(connection):
+    """Returns the schema version recorded in the database, or ``0`` if none has
+    been recorded.
+    """
+    
+    try:
+        return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+    except DBAPIError:
+        # No version table; the database predates versioning or is empty
+        return 0
+
+
+def check_version(engine):
+    """Raises :class:`SchemaVersionError` if the database's schema is older
+    than this version of Sneeze requires.  Costs one query.
+    """
+    
+    connection = engine.connect()
+    try:
+        version = get_version(connection)
+    finally:
+        connection.close()
+    if version < CURRENT_VERSION:
+        raise SchemaVersionError('Reporting database schema is at version %d, Sneeze requires '
+                                 'version %d; run sneeze-upgrade-db to upgrade it.'
+                                 % (version, CURRENT_VERSION))
+
+
+def create_schema(engine, declarative_base=Base):
+    """Creates the tables missing from the database.  A database that had none
+    of the Sneeze tables is recorded as being at the current schema version;
+    any other must already be, and :func:`check_version` is applied to it.
+    Migrations are only applied by :func:`upgrade`\ , as they may rebuild
+    indexes and alter large tables.
+    
+    :param engine: Engine for the database.
+    :type engine: `SQLAlchemy engine
+        <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+    :param declarative_base: The base the Sneeze models were derived from.
+    :type declarative_base: `SQLAlchemy declarative base
+        <http://docs.sqlalchemy.org/en/rel_0_8/orm/extensions/declarative.html>`_
+    """
+    
+    from sneeze.database.interface import load_models
+    load_models(declarative_base)
+    connection = engine.connect()
+    try:
+        existing = set(inspect(connection).get_table_names())
+        empty = not existing.intersection(declarative_base.metadata.tables)
+        declarative_base.metadata.create_all(connection)
+        _version_metadata.create_all(connection)
+        if empty:
+            transaction = connection.begin()
+            try:
+                if not get_version(connection):
+                    connection.execute(schema_version.insert(),
+                                       [{'version' : number, 'description' : description,
+                                         'applied' : datetime.now()}
+                                        for number, description, migrate in MIGRATIONS])
+                transaction.commit()
+            except DBAPIError:
+                # Another run created the database at the same time and recorded it first
+                transaction.rollback()
+    finally:
+        connection.close()
+    check_version(engine)
+
+
+def upgrade(engine, declarative_base=Base):
+    """Applies every migration newer than the database's recorded schema
+    version, each in its own transaction.
+    
+    :param engine: Engine for the database to upgrade.
+    :type engine: `SQLAlchemy engine
+        <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+    :param declarative_base: The base the Sneeze models were derived from.
+    :type declarative_base: `SQLAlchemy declarative base
+        <http://docs.sqlalchemy.org/en/rel_0_8/orm/extensions/declarative.html>`_
+    
+    :returns: The schema version of the database after the upgrade.
+    """
+    
+    from sneeze.database.interface import load_models
+    load_models(declarative_base)
+    connection = engine.connect()
+    try:
+        _version_metadata.create_all(connection)
+        version = get_version(connection)
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            log.info('Applying schema version %d: %s', number, description)
+            transaction = connection.begin()
+            try:
+                migrate(connection, declarative_base.metadata)
+                connection.execute(schema_version.insert().values(version=number,
+                                                                  description=description,
+                                                                  applied=datetime.now()))
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            version = number
+        return version
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.stderr.write('usage: sneeze-upgrade-db CONFIG_STRING\n')
+        return 2
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(argv[0])
+    from sneeze.database.interface import load_models
+    load_models(Base)
+    Base.metadata.create_all(engine)
+    version = upgrade(engine)
+    print 'Schema is at version %d.' % version
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,15 @@
 from sqlalchemy.ext.declarative import declarative_base#, DeclarativeMeta
 #from sqlalchemy.ext.declarative.api import _declarative_constructor
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Enum, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, Enum, DateTime
+from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.ext.associationproxy import association_proxy
 from datetime import datetime
-from sqlalchemy import event
-from passlib.hash import bcrypt, sha256_crypt
+from sqlalchemy import event, func, distinct, literal, and_, case as case_when
 from datetime import timedelta
 from multiprocessing import current_process
 from collections import defaultdict
+from sneeze.database import verification
+import hashlib, json
 
 
 #def _declarative_base():
@@ -49,6 +50,33 @@ class ReverseMappingTuple(tuple):
 
 EXECUTION_STATUSES = ReverseMappingTuple(('RUNNING', 'COMPLETE', 'ZOMBIE'))
 
+RESULTS = ('PENDING', 'PASS', 'FAIL', 'SKIP')
+
+# Keys of the dicts returned by the summary methods of TestCycle and ExecutionBatch
+SUMMARY_FIELDS = ('total',) + tuple(result.lower() for result in RESULTS) + ('running_batches',)
+
+
+def encode_address(test_address_parts):
+    """Returns the stored form of a test address and its digest, as a 2-tuple."""
+    
+    encoded = json.dumps(list(test_address_parts))
+    return encoded, hashlib.sha1(encoded).hexdigest()
+
+
+def _pages(query, id_column, page_size):
+    
+    # Keyset paging; the cost of each page does not grow with its offset
+    last_id = None
+    while True:
+        page_query = query
+        if last_id is not None:
+            page_query = page_query.filter(id_column > last_id)
+        page = page_query.order_by(id_column).limit(page_size).all()
+        if not page:
+            return
+        yield page
+        last_id = getattr(page[-1], id_column.key)
+
 
 def encryption_rounds(timestamp):
     
@@ -73,11 +101,41 @@ def add_models(Base_=Base):
         __tablename__ = 'test_case'
         
         id = Column(Integer, primary_key=True)
-        label = Column(String(200))
+        # Not unique; default cases are inserted with an empty label that is
+        # filled in once the execution batch has an id
+        label = Column(String(200), index=True)
         
         def __init__(self, label=''):
             
             self.label = label
+        
+        def case_execution_pages(self, page_size=1000):
+            """Yields the ``Case``\ 's executions in ``list``\ s of at most
+            ``page_size``\ , in id order.  ``case_executions`` is a dynamic
+            query, so appending to it does not load the existing executions.
+            """
+            
+            return _pages(self.case_executions, CaseExecution.id, page_size)
+    
+    
+    class Address(Base_):
+        """A test address stored once and referenced by every
+        :term:`Case Execution` recorded with it, for ``Tissue``\ s using compact
+        addresses.
+        """
+        
+        __tablename__ = 'test_address'
+        
+        id = Column(Integer, primary_key=True)
+        # Not unique; concurrent batches may both insert a new address, and
+        # lookups take the lowest id
+        digest = Column(String(40), index=True)
+        parts = Column(Text)
+        
+        @property
+        def part_list(self):
+            
+            return json.loads(self.parts)
     
     
     class TestCycleCaseExecution(Base_):
@@ -85,9 +143,12 @@ def add_models(Base_=Base):
         __tablename__ = 'test_cycle_test_case_execution'
         
         test_cycle_id = Column(Integer, ForeignKey('test_cycle.id'), primary_key=True)
-        case_execution_id = Column(Integer, ForeignKey('test_case_execution.id'), primary_key=True)
+        # The primary key covers lookups by cycle; this covers lookups by execution
+        case_execution_id = Column(Integer, ForeignKey('test_case_execution.id'), primary_key=True,
+                                   index=True)
         include_in_reporting = Column(Boolean)
-        test_cycle = relationship('TestCycle', backref='case_execution_associations')
+        test_cycle = relationship('TestCycle', backref=backref('case_execution_associations',
+                                                               lazy='dynamic'))
         case_execution = relationship('CaseExecution', backref='test_cycle_associations')
         
         def __init__(self, test_cycle=None, case_execution=None, include_in_reporting=True):
@@ -117,13 +178,16 @@ def add_models(Base_=Base):
         
         id = Column(Integer, primary_key=True)
         description = Column(String(300))
-        result = Column(Enum('PENDING', 'PASS', 'FAIL', 'SKIP'))
-        execution_batch_id = Column(Integer, ForeignKey('execution_batch.id'))
-        execution_batch = relationship('ExecutionBatch', backref='case_executions')
-        case_id = Column(Integer, ForeignKey('test_case.id'))
-        case = relationship(Case, backref='case_executions')
+        result = Column(Enum(*RESULTS))
+        execution_batch_id = Column(Integer, ForeignKey('execution_batch.id'), index=True)
+        execution_batch = relationship('ExecutionBatch', backref=backref('case_executions',
+                                                                         lazy='dynamic'))
+        case_id = Column(Integer, ForeignKey('test_case.id'), index=True)
+        case = relationship(Case, backref=backref('case_executions', lazy='dynamic'))
         start_time = Column(DateTime)
         end_time = Column(DateTime, nullable=True)
+        address_id = Column(Integer, ForeignKey('test_address.id'), nullable=True, index=True)
+        address = relationship(Address)
         test_cycles = association_proxy('test_cycle_associations', 'test_cycle',
                                         creator=TestCycleCaseExecution._link_creator)
         
@@ -155,6 +219,16 @@ def add_models(Base_=Base):
             
             return EXECUTION_STATUSES[self.status_id]
         
+        @property
+        def test_address(self):
+            """The test address parts, as a ``list`` of ``string``\ s, whether
+            they were recorded compactly or as ``address_parts`` rows.
+            """
+            
+            if self.address_id is not None:
+                return self.address.part_list
+            return [address_part.part for address_part in self.address_parts]
+        
         @property
         def status_id(self):
             
@@ -171,7 +245,7 @@ def add_models(Base_=Base):
         
         id = Column(Integer, primary_key=True)
         part = Column(String(200))
-        case_execution_id = Column(Integer, ForeignKey('test_case_execution.id'))
+        case_execution_id = Column(Integer, ForeignKey('test_case_execution.id'), index=True)
         case_execution = relationship(CaseExecution, backref='address_parts')
     
     class ExecutionBatch(Base_):
@@ -210,6 +284,24 @@ def add_models(Base_=Base):
                 return EXECUTION_STATUSES.ZOMBIE
             else:
                 return EXECUTION_STATUSES.COMPLETE
+        
+        def case_execution_pages(self, page_size=1000):
+            """Yields the batch's executions in ``list``\ s of at most
+            ``page_size``\ , in id order.
+            """
+            
+            return _pages(self.case_executions, CaseExecution.id, page_size)
+        
+        def summary(self, include_default_cases=False):
+            
+            return ExecutionBatch.summaries(object_session(self), [self.id],
+                                            include_default_cases)[self.id]
+        
+        @staticmethod
+        def summaries(session, ids=None, include_default_cases=False):
+            
+            return _summaries(session, CaseExecution.execution_batch_id, ids,
+                              include_default_cases)
     
     
     def _update_default_case_label(mapper, connection, target):
@@ -224,6 +316,52 @@ def add_models(Base_=Base):
     event.listen(ExecutionBatch, 'after_insert', _update_default_case_label)
     
     
+    def _summary_query(session, group_by, ids, include_default_cases, *leading):
+        
+        # One row per group with the counts for every result and the number of
+        # distinct unfinished batches, so a summary costs a single query.  Default
+        # cases are left out of the counts rather than the rows, so that a batch
+        # that has only run its default case still counts as running
+        counted = [] if include_default_cases else [CaseExecution.case_id!=ExecutionBatch.default_case_id]
+        
+        def count_if(*conditions):
+            
+            conditions = counted + list(conditions)
+            if not conditions:
+                return func.count(CaseExecution.id)
+            return func.sum(case_when([(and_(*conditions), 1)], else_=0))
+        
+        columns = list(leading) + [group_by, count_if()]
+        columns.extend(count_if(CaseExecution.result==result) for result in RESULTS)
+        columns.append(func.count(distinct(case_when([(ExecutionBatch.end_time==None,
+                                                       ExecutionBatch.id)]))))
+        query = (session.query(*columns)
+                 .select_from(CaseExecution)
+                 .join(ExecutionBatch, CaseExecution.execution_batch_id==ExecutionBatch.id))
+        if group_by is TestCycleCaseExecution.test_cycle_id:
+            query = query.join(TestCycleCaseExecution,
+                               TestCycleCaseExecution.case_execution_id==CaseExecution.id)
+        if ids is not None:
+            query = query.filter(group_by.in_(ids))
+        return query.group_by(group_by)
+    
+    
+    def _summary(row):
+        
+        return dict(zip(SUMMARY_FIELDS, [int(value or 0) for value in row]))
+    
+    
+    def _summaries(session, group_by, ids, include_default_cases):
+        
+        if ids is not None:
+            ids = list(ids)
+        query = _summary_query(session, group_by, ids, include_default_cases)
+        summaries = dict((row[0], _summary(row[1:])) for row in query)
+        for id_ in ids or ():
+            summaries.setdefault(id_, dict.fromkeys(SUMMARY_FIELDS, 0))
+        return summaries
+    
+    
     class TestCycle(Base_):
         
         __tablename__ = 'test_cycle'
@@ -236,7 +374,47 @@ def add_models(Base_=Base):
         @property
         def running_count(self):
             
-            return len(set(_.execution_batch.id for _ in self.case_executions if _.execution_batch.end_time is None))
+            return self.summary()['running_batches']
+        
+        def case_execution_pages(self, page_size=1000):
+            """Yields the cycle's executions in ``list``\ s of at most
+            ``page_size``\ , in id order.
+            """
+            
+            query = (object_session(self).query(CaseExecution)
+                     .join(TestCycleCaseExecution,
+                           TestCycleCaseExecution.case_execution_id==CaseExecution.id)
+                     .filter(TestCycleCaseExecution.test_cycle_id==self.id))
+            return _pages(query, CaseExecution.id, page_size)
+        
+        def summary(self, include_default_cases=False):
+            
+            return TestCycle.summaries(object_session(self), [self.id],
+                                       include_default_cases)[self.id]
+        
+        @staticmethod
+        def summaries(session, ids=None, include_default_cases=False):
+            
+            return _summaries(session, TestCycleCaseExecution.test_cycle_id, ids,
+                              include_default_cases)
+        
+        @staticmethod
+        def summary_with_batch(session, test_cycle_id, execution_batch_id,
+                               include_default_cases=False):
+            """Returns the summaries of a cycle and of a batch, as a 2-tuple, from
+            a single query.
+            """
+            
+            # Each half of the union is tagged, as cycle and batch ids may collide
+            query = (_summary_query(session, TestCycleCaseExecution.test_cycle_id,
+                                    [test_cycle_id], include_default_cases, literal(0))
+                     .union_all(_summary_query(session, CaseExecution.execution_batch_id,
+                                               [execution_batch_id], include_default_cases,
+                                               literal(1))))
+            summaries = [dict.fromkeys(SUMMARY_FIELDS, 0), dict.fromkeys(SUMMARY_FIELDS, 0)]
+            for row in query:
+                summaries[row[0]] = _summary(row[2:])
+            return tuple(summaries)
     
     
     class UserToken(Base_):
@@ -294,14 +472,29 @@ def add_models(Base_=Base):
             
             self.revoked = True
         
-        def verify(self, salt, value=None):
+        def verify(self, salt, value=None, cache=None, pool=None):
+            """Checks ``value``\ , by default the user's name, against the token.
+            
+            :param cache: If given, results are cached in it while the token is
+                active; revoked, expired and used up tokens are always hashed.
+            :type cache: :class:`sneeze.database.verification.VerificationCache`
+                or ``None``
+            :param pool: If given, hashing runs in it and a result object is
+                returned; see :func:`sneeze.database.verification.verify`\ .
+            """
             
             if value is None:
                 value = self.user.name
             crypt = '$5${}${}${}'.format('rounds=' + str(encryption_rounds(self.create_time)),
                                          salt,
                                          self.value)
-            return sha256_crypt.verify(value, crypt)
+            key = None
+            if cache is not None:
+                key = cache.key('token', self.id, crypt, value)
+                if not self.active:
+                    cache.discard(key)
+                    key = None
+            return verification.verify('sha256_crypt', value, crypt, cache, key, pool)
     
     
     class User(Base_):
@@ -320,11 +513,18 @@ def add_models(Base_=Base):
         @password.setter
         def password(self, passw):
             
+            from passlib.hash import bcrypt
             self.password_crypt = bcrypt.encrypt(passw)
         
-        def verify_password(self, passw):
+        def verify_password(self, passw, cache=None, pool=None):
+            """Checks ``passw`` against the stored bcrypt hash.  ``cache`` and
+            ``pool`` are as for ``UserToken.verify``\ .
+            """
             
-            return bcrypt.verify(passw, self.password_crypt)
+            key = None
+            if cache is not None:
+                key = cache.key('user', self.id, self.password_crypt, passw)
+            return verification.verify('bcrypt', passw, self.password_crypt, cache, key, pool)
         
         def get_new_token(self, salt, expires=None, max_uses=None):
             
@@ -336,6 +536,7 @@ def add_models(Base_=Base):
                     expires = now + expires
                 except TypeError:
                     pass
+            from passlib.hash import sha256_crypt
             crypt = sha256_crypt.encrypt(self.name,
                                          rounds=encryption_rounds(now),
                                          salt=salt)
@@ -349,5 +550,6 @@ def add_models(Base_=Base):
     
     return {'Case' : Case, 'TestCycle' : TestCycle,
             'CaseExecution' : CaseExecution, 'ExecutionBatch' : ExecutionBatch,
-            'CaseExecutionAddressPart' : CaseExecutionAddressPart,
+            'CaseExecutionAddressPart' : CaseExecutionAddressPart, 'Address' : Address,
+            'TestCycleCaseExecution' : TestCycleCaseExecution,
             'User' : User, 'UserToken' : UserToken}
\ No newline at end of file
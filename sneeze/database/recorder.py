@@ -0,0 +1,481 @@
+'''Recorders take over writing :term:`Case Execution` state to the database from
+the :doc:`Tissue <tissue>`.  When a recorder is attached to a Tissue, the
+Tissue turns case entries and exits into events and hands them to the recorder
+instead of writing them in the calling thread.
+'''
+
+
+from threading import Thread
+from Queue import Queue, Full, Empty
+import multiprocessing
+from sqlalchemy import func, select
+import logging, time
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindRecorder(object):
+    """Records case events from a background writer thread.  Events are pushed
+    onto a bounded queue by the test thread, and the writer drains the queue,
+    committing up to ``batch_size`` events per
+    :meth:`~sneeze.database.interface.Tissue.session_transaction`\ .
+    
+    Because events are written after the fact, :term:`Plugin Manager`\ s
+    should not rely on ``Tissue.case_execution`` while a recorder is in use.
+    """
+    
+    def __init__(self, queue_size=1000, batch_size=100, block=True,
+                 at_least_once=True, max_retries=5, retry_interval=1.0):
+        """
+        :param queue_size: Maximum number of events waiting to be written.
+        :type queue_size: ``int``
+        :param batch_size: Maximum number of events written per transaction.
+        :type batch_size: ``int``
+        :param block: If ``True``, the test thread waits for space when the queue
+            is full.  If ``False``, the case entered while the queue is full is not
+            recorded, and the count of dropped events is kept in ``dropped``.
+            Defaults to ``True``.
+        :type block: ``bool``
+        :param at_least_once: If ``True``, a batch that fails to commit is retried
+            up to ``max_retries`` times before the recorder gives up.  If ``False``,
+            a failed batch is logged and discarded.  Defaults to ``True``.
+        :type at_least_once: ``bool``
+        :param max_retries: Number of retries for a failed batch.  ``None``
+            retries forever.
+        :type max_retries: ``int`` or ``None``
+        :param retry_interval: Seconds to wait between retries.
+        :type retry_interval: ``float``
+        """
+        
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.block = block
+        self.at_least_once = at_least_once
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.dropped = 0
+        self.error = None
+        self.tissue = None
+        self.thread = None
+        self.state = None
+        self._dropping = False
+    
+    def start(self, tissue):
+        """Attach the recorder to ``tissue`` and start the writer thread."""
+        
+        self.tissue = tissue
+        self.state = _stream_state(tissue.execution_batch.id,
+                                   tissue.execution_batch.default_case_id)
+        self.thread = Thread(target=self._drain, name='sneeze-recorder')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def put(self, event):
+        """Queue an event for writing.
+        
+        :param event: A tuple whose first item names the
+            :class:`~sneeze.database.interface.Tissue` event (``'enter_case'``\ ,
+            ``'exit_case'`` or ``'exit'``) and whose remaining items are the
+            event's arguments.  A case of ``None`` in an ``'enter_case'`` event
+            stands for the :term:`Default Case` of the event's
+            :term:`Execution Batch`\ .
+        :type event: ``tuple``
+        """
+        
+        if self.error is not None:
+            raise self.error
+        if self.block or event[0] == 'exit':
+            self.queue.put(event)
+            return
+        # An exit belongs to the last enter; if the enter was dropped, so is
+        # the exit, otherwise the result would land on the wrong execution
+        if event[0] == 'exit_case' and self._dropping:
+            self._dropping = False
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+            self._dropping = event[0] == 'enter_case'
+        else:
+            self._dropping = False
+    
+    def close(self):
+        """Wait for all queued events to be written and stop the writer thread."""
+        
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.dropped:
+            log.warning('%d case events were dropped by the sneeze recorder.', self.dropped)
+        if self.error is not None:
+            raise self.error
+    
+    def _drain(self):
+        
+        done = False
+        while not done:
+            events = [self.queue.get()]
+            while len(events) < self.batch_size:
+                try:
+                    events.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if None in events:
+                events = events[:events.index(None)]
+                done = True
+            if self.error is not None:
+                # Keep draining so a blocked test thread gets to see the error
+                continue
+            try:
+                self._write_with_retry(events)
+            except Exception, e:
+                self.error = e
+    
+    def _write_with_retry(self, events):
+        
+        attempt = 0
+        while True:
+            try:
+                self._write(events)
+                return
+            except Exception:
+                if not self.at_least_once:
+                    log.exception('Discarding %d case events that failed to write.', len(events))
+                    return
+                if self.max_retries is not None and attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                log.warning('Writing case events failed, retrying (%d).', attempt, exc_info=True)
+                time.sleep(self.retry_interval)
+    
+    def _write(self, events):
+        
+        # State is only kept once the batch commits, so a retried batch starts
+        # from the same place as the failed one
+        state = dict(self.state)
+        with self.tissue.session_transaction() as session:
+            for event in events:
+                _apply_event(self.tissue, session, state, event[0], event[1:])
+            session.flush()
+            _settle_state(state)
+        self.state = state
+
+
+class WorkerAggregator(WriteBehindRecorder):
+    """Writes the case events of every multiprocess worker from a single thread
+    in the parent process, over the parent :doc:`Tissue <tissue>`\ 's
+    connection.  Workers send their events through a
+    :class:`WorkerRecorder` from :meth:`worker_recorder`\ .  Each worker's
+    executions are recorded in an :term:`Execution Batch` of its own, created
+    by the aggregator when the worker's first event arrives, with the worker's
+    host and pid as the batch's host.
+    
+    The aggregator must be started before the workers are forked, so that they
+    inherit its queue.
+    """
+    
+    def __init__(self, queue_size=10000, batch_size=100, at_least_once=True,
+                 max_retries=5, retry_interval=1.0):
+        
+        WriteBehindRecorder.__init__(self, batch_size=batch_size, at_least_once=at_least_once,
+                                     max_retries=max_retries, retry_interval=retry_interval)
+        self.queue = multiprocessing.Queue(queue_size)
+        self.workers = {}
+    
+    def start(self, tissue):
+        """Attach the aggregator to the parent ``tissue`` and start the writer
+        thread.
+        """
+        
+        self.tissue = tissue
+        self.thread = Thread(target=self._drain, name='sneeze-aggregator')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def worker_recorder(self, host, pid):
+        """Returns the recorder for a worker :doc:`Tissue <tissue>`\ ."""
+        
+        return WorkerRecorder(self.queue, (host, pid))
+    
+    def _write(self, events):
+        
+        tissue = self.tissue
+        ExecutionBatch = tissue.db_models['ExecutionBatch']
+        workers = dict((worker, dict(state)) for worker, state in self.workers.iteritems())
+        with tissue.session_transaction() as session:
+            for event in events:
+                worker, name, args = event[0], event[1], event[2:]
+                state = workers.get(worker)
+                if state is None:
+                    execution_batch = ExecutionBatch(environment=tissue.execution_batch.environment,
+                                                     host='%s:%d' % worker,
+                                                     arguments=tissue.execution_batch.arguments,
+                                                     start_time=args[-1])
+                    session.add(execution_batch)
+                    session.flush()
+                    state = workers[worker] = _stream_state(execution_batch.id,
+                                                            execution_batch.default_case_id)
+                _apply_event(tissue, session, state, name, args)
+            session.flush()
+            for state in workers.itervalues():
+                _settle_state(state)
+        self.workers = workers
+
+
+class WorkerRecorder(object):
+    """Sends a multiprocess worker's case events to the parent's
+    :class:`WorkerAggregator`\ , tagged with the worker's host and pid.
+    """
+    
+    def __init__(self, queue, worker):
+        
+        self.queue = queue
+        self.worker = worker
+    
+    def start(self, tissue):
+        
+        pass
+    
+    def put(self, event):
+        
+        self.queue.put((self.worker,) + event)
+    
+    def close(self):
+        """Wait for the worker's events to be handed to the parent."""
+        
+        self.queue.close()
+        self.queue.join_thread()
+
+
+def _stream_state(execution_batch_id, default_case_id):
+    
+    return {'execution_batch_id' : execution_batch_id, 'default_case_id' : default_case_id,
+            'case_execution_id' : None, 'case_execution' : None, 'in_default_case' : False}
+
+
+def _apply_event(tissue, session, state, name, args):
+    
+    # Applies one event to a stream of events from a single execution batch;
+    # state holds the stream's current execution between events
+    CaseExecution = tissue.db_models['CaseExecution']
+    case_execution = state['case_execution']
+    if case_execution is None and state['case_execution_id'] is not None:
+        case_execution = session.query(CaseExecution).get(state['case_execution_id'])
+    if name == 'enter_case':
+        case, test_address_parts, description, start_time = args
+        if case is None:
+            case = state['default_case_id']
+        if case_execution is not None and state['in_default_case']:
+            case_execution.end_time = start_time
+            case_execution.result = 'PASS'
+        case = tissue.resolve_case(session, case)
+        case_execution = tissue.add_case_execution(session, case, test_address_parts,
+                                                   description, start_time,
+                                                   state['execution_batch_id'])
+        state['in_default_case'] = case.id is not None and case.id == state['default_case_id']
+    elif name == 'exit_case':
+        result, end_time = args
+        case_execution.end_time = end_time
+        case_execution.result = result
+        # Nothing closes an exited execution again, even when no default case
+        # is entered after it, as with lazy_default_cases
+        case_execution = state['case_execution_id'] = None
+    elif name == 'exit':
+        end_time, = args
+        if case_execution is not None:
+            case_execution.result = 'PASS'
+            case_execution.end_time = end_time
+        ExecutionBatch = tissue.db_models['ExecutionBatch']
+        session.query(ExecutionBatch).get(state['execution_batch_id']).end_time = end_time
+    state['case_execution'] = case_execution
+
+
+def _settle_state(state):
+    
+    # Called after a flush; only the id of the current execution outlives the session
+    if state['case_execution'] is not None:
+        state['case_execution_id'] = state['case_execution'].id
+    state['case_execution'] = None
+
+
+class BulkInsertRecorder(object):
+    """Records case events by buffering completed :term:`Case Execution`\ s and
+    writing them ``batch_size`` at a time.  Each flush writes the executions,
+    their address parts and their :term:`Test Cycle` links with one
+    ``executemany`` insert per table, rather than one ORM flush per test.
+    
+    Executions are written in the calling thread once they are complete, so
+    like :class:`WriteBehindRecorder`\ , :term:`Plugin Manager`\ s should not
+    rely on ``Tissue.case_execution`` while this recorder is in use.
+    """
+    
+    def __init__(self, batch_size=500):
+        """
+        :param batch_size: Number of completed :term:`Case Execution`\ s to
+            buffer before writing them.  Defaults to ``500``.
+        :type batch_size: ``int``
+        """
+        
+        self.batch_size = batch_size
+        self.tissue = None
+        self.current = None
+        self.in_default_case = False
+        self.completed = []
+        self.end_time = None
+        self.last_case_execution_id = None
+    
+    def start(self, tissue):
+        """Attach the recorder to ``tissue``\ ."""
+        
+        self.tissue = tissue
+        self.execution_batch_id = tissue.execution_batch.id
+        self.test_cycle_id = tissue.test_cycle.id
+        self.default_case_id = tissue.execution_batch.default_case_id
+    
+    def put(self, event):
+        """Apply an event to the buffered executions, writing them if
+        ``batch_size`` executions have completed.  See
+        :meth:`WriteBehindRecorder.put` for the event format.
+        """
+        
+        name, args = event[0], event[1:]
+        if name == 'enter_case':
+            case, test_address_parts, description, start_time = args
+            if self.current is not None:
+                # Only the default case is closed implicitly; anything else is
+                # left PENDING, as it would be by the Tissue
+                if self.in_default_case:
+                    self._complete('PASS', start_time)
+                else:
+                    self.completed.append(self.current)
+            self.current = {'case' : case, 'address_parts' : test_address_parts,
+                            'description' : description, 'start_time' : start_time,
+                            'end_time' : None, 'result' : 'PENDING'}
+            self.in_default_case = self._case_key(case) == ('id', self.default_case_id)
+        elif name == 'exit_case':
+            result, end_time = args
+            self._complete(result, end_time)
+        elif name == 'exit':
+            self.end_time, = args
+            if self.current is not None:
+                self._complete('PASS', self.end_time)
+        if len(self.completed) >= self.batch_size:
+            self.flush()
+    
+    def close(self):
+        """Write all buffered executions and close out the :term:`Execution Batch`\ ."""
+        
+        if self.current is not None:
+            self.completed.append(self.current)
+            self.current = None
+        self.flush()
+        if self.end_time is not None:
+            with self.tissue.session_transaction():
+                self.tissue.execution_batch.end_time = self.end_time
+    
+    def flush(self):
+        """Write all completed executions in one transaction."""
+        
+        if not self.completed:
+            return
+        executions = self.completed
+        models = self.tissue.db_models
+        execution_table = models['CaseExecution'].__table__
+        part_table = models['CaseExecutionAddressPart'].__table__
+        link_table = models['TestCycleCaseExecution'].__table__
+        with self.tissue.session_transaction() as session:
+            case_ids = self._case_ids(session, [execution['case'] for execution in executions])
+            if self.tissue.compact_addresses:
+                address_ids = self.tissue.address_ids(session, [execution['address_parts']
+                                                                for execution in executions])
+            else:
+                address_ids = {}
+            if self.last_case_execution_id is None:
+                self.last_case_execution_id = (session.query(func.max(execution_table.c.id))
+                                               .filter(execution_table.c.execution_batch_id==self.execution_batch_id)
+                                               .scalar()) or 0
+            session.execute(execution_table.insert(),
+                            [{'case_id' : case_ids[self._case_key(execution['case'])],
+                              'execution_batch_id' : self.execution_batch_id,
+                              'address_id' : address_ids.get(tuple(execution['address_parts'])),
+                              'description' : execution['description'],
+                              'result' : execution['result'],
+                              'start_time' : execution['start_time'],
+                              'end_time' : execution['end_time']}
+                             for execution in executions])
+            # Nothing else writes to this Tissue's execution batch, so the new
+            # rows are the ones past the last id, in insertion order
+            ids = [row[0] for row in
+                   session.execute(select([execution_table.c.id])
+                                   .where(execution_table.c.execution_batch_id==self.execution_batch_id)
+                                   .where(execution_table.c.id > self.last_case_execution_id)
+                                   .order_by(execution_table.c.id))]
+            parts = [{'case_execution_id' : id_, 'part' : part}
+                     for id_, execution in zip(ids, executions)
+                     if not self.tissue.compact_addresses
+                     for part in execution['address_parts']]
+            if parts:
+                session.execute(part_table.insert(), parts)
+            session.execute(link_table.insert(),
+                            [{'test_cycle_id' : self.test_cycle_id,
+                              'case_execution_id' : id_,
+                              'include_in_reporting' : True}
+                             for id_ in ids])
+        self.last_case_execution_id = ids[-1]
+        self.completed = []
+    
+    def _complete(self, result, end_time):
+        
+        self.current['result'] = result
+        self.current['end_time'] = end_time
+        self.completed.append(self.current)
+        self.current = None
+    
+    def _case_key(self, case):
+        
+        Case = self.tissue.db_models['Case']
+        if isinstance(case, Case):
+            if case.id is not None:
+                return ('id', case.id)
+            case = case.label
+        try:
+            return ('id', int(case))
+        except ValueError:
+            return ('label', case)
+    
+    def _case_ids(self, session, cases):
+        
+        tissue = self.tissue
+        case_table = tissue.db_models['Case'].__table__
+        case_cache = tissue.case_cache
+        keys = set(self._case_key(case) for case in cases)
+        case_ids = dict((key, key[1]) for key in keys if key[0] == 'id')
+        labels = set()
+        for kind, label in keys:
+            if kind == 'label':
+                id_ = case_cache.get(label)
+                if id_ is None:
+                    labels.add(label)
+                else:
+                    case_ids[('label', label)] = id_
+        
+        def load_labels():
+            
+            query = (select([case_table.c.label, func.min(case_table.c.id)])
+                     .where(case_table.c.label.in_(list(labels)))
+                     .group_by(case_table.c.label))
+            for label, id_ in session.execute(query):
+                case_ids[('label', label)] = id_
+                tissue.cache_on_commit(session, case_cache, label, id_)
+                labels.discard(label)
+        
+        if labels:
+            load_labels()
+        if labels:
+            session.execute(case_table.insert(), [{'label' : label} for label in labels])
+            load_labels()
+        return case_ids
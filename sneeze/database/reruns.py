@@ -0,0 +1,92 @@
+'''Queries for selecting the tests of a rerun.  Addresses are streamed as
+``(execution id, address parts)`` pairs straight from joined rows, without
+loading :term:`Case Execution` objects or their relationships.  Addresses
+recorded either as address part rows or compactly are both handled.
+'''
+
+
+from sqlalchemy import select, func
+import json
+
+
+def _address_query(models):
+    
+    Execution = models['CaseExecution'].__table__
+    Part = models['CaseExecutionAddressPart'].__table__
+    Address = models['Address'].__table__
+    return (select([Execution.c.id, Address.c.parts, Part.c.part])
+            .select_from(Execution.outerjoin(Address, Address.c.id==Execution.c.address_id)
+                         .outerjoin(Part, Part.c.case_execution_id==Execution.c.id))
+            .order_by(Execution.c.id, Part.c.id))
+
+
+def _group_parts(rows):
+    
+    execution_id, parts = None, []
+    for row_execution_id, encoded, part in rows:
+        if row_execution_id != execution_id:
+            if parts:
+                yield execution_id, parts
+            execution_id, parts = row_execution_id, []
+            if encoded is not None:
+                parts.extend(json.loads(encoded))
+                continue
+        if part is not None:
+            parts.append(part)
+    if parts:
+        yield execution_id, parts
+
+
+def rerun_addresses(session, models, execution_ids, chunk_size=500):
+    """Yields the address parts of the :term:`Case Execution`\ s with the given
+    ids, as ``(execution id, list of parts)`` pairs in execution id order, using
+    one query per ``chunk_size`` ids.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    execution_ids = sorted(set(execution_ids))
+    for start in xrange(0, len(execution_ids), chunk_size):
+        query = (_address_query(models)
+                 .where(Execution.c.id.in_(execution_ids[start:start + chunk_size])))
+        for address in _group_parts(session.execute(query)):
+            yield address
+
+
+def failure_addresses(session, models, test_cycle_id):
+    """Yields the address parts of the failed tests of a :term:`Test Cycle`\ , as
+    ``(execution id, list of parts)`` pairs, from a single query.  A test counts
+    as failed if the last execution of its :term:`Test Case` in the cycle failed.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    Link = models['TestCycleCaseExecution'].__table__
+    latest = (select([func.max(Execution.c.id).label('id')])
+              .select_from(Execution.join(Link, Link.c.case_execution_id==Execution.c.id))
+              .where(Link.c.test_cycle_id==test_cycle_id)
+              .group_by(Execution.c.case_id)
+              .alias('latest'))
+    query = (_address_query(models)
+             .where(Execution.c.id.in_(select([latest.c.id])))
+             .where(Execution.c.result=='FAIL'))
+    return _group_parts(session.execute(query))
+
+
+def rerun_cycle_id(session, models, execution_ids):
+    """Returns the id of the only :term:`Test Cycle` that every one of the
+    :term:`Case Execution`\ s with the given ids belongs to, or ``None`` if
+    there is no such single cycle.  Ids of executions that do not exist, such
+    as pruned ones, are ignored.  Uses one query.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    Link = models['TestCycleCaseExecution'].__table__
+    execution_ids = set(execution_ids)
+    found = (select([func.count(Execution.c.id)])
+             .where(Execution.c.id.in_(execution_ids))
+             .as_scalar())
+    query = (select([Link.c.test_cycle_id])
+             .where(Link.c.case_execution_id.in_(execution_ids))
+             .group_by(Link.c.test_cycle_id)
+             .having(func.count(Link.c.case_execution_id.distinct())==found))
+    cycle_ids = [row[0] for row in session.execute(query)]
+    return cycle_ids[0] if len(cycle_ids) == 1 else None
@@ -0,0 +1,246 @@
+'''Prunes old execution history.  :term:`Test Cycle`\ s whose last
+:term:`Case Execution` started before a cutoff are archived to gzipped JSON
+lines files, one per cycle, and deleted a chunk of executions at a time.  Each
+chunk is deleted in its own short transaction, so recording into the live
+tables is never blocked for long::
+    
+    sneeze-prune-db --older-than-days 90 --archive-dir /var/archive/sneeze CONFIG_STRING
+
+Rows of models added by plugins that reference :term:`Case Execution`\ s must
+be pruned by those plugins first.  :term:`Test Case`\ s and compact addresses
+are shared across cycles and are kept.
+'''
+
+
+from sqlalchemy import create_engine, select, func
+from optparse import OptionParser
+from datetime import datetime, timedelta
+from sneeze.database.models import Base
+import os, sys, json, gzip, time, logging
+
+
+log = logging.getLogger(__name__)
+
+
+def _isoformat(value):
+    
+    return value.isoformat() if value is not None else None
+
+
+def expired_cycle_ids(connection, models, before):
+    """Returns the ids of the :term:`Test Cycle`\ s whose latest
+    :term:`Case Execution` started before ``before``\ , oldest first.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    Link = models['TestCycleCaseExecution'].__table__
+    last_start = func.max(Execution.c.start_time)
+    query = (select([Link.c.test_cycle_id])
+             .select_from(Link.join(Execution, Execution.c.id==Link.c.case_execution_id))
+             .group_by(Link.c.test_cycle_id)
+             .having(last_start < before)
+             .order_by(last_start))
+    return [row[0] for row in connection.execute(query)]
+
+
+class _Pruner(object):
+    
+    def __init__(self, connection, models, archive_dir, chunk_size, pause):
+        
+        self.connection = connection
+        self.archive_dir = archive_dir
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.cases = models['Case'].__table__
+        self.cycles = models['TestCycle'].__table__
+        self.batches = models['ExecutionBatch'].__table__
+        self.executions = models['CaseExecution'].__table__
+        self.parts = models['CaseExecutionAddressPart'].__table__
+        self.addresses = models['Address'].__table__
+        self.links = models['TestCycleCaseExecution'].__table__
+    
+    def cycle(self, cycle_id):
+        
+        connection = self.connection
+        cycle = connection.execute(self.cycles.select().where(self.cycles.c.id==cycle_id)).first()
+        archive = None
+        if self.archive_dir is not None:
+            path = os.path.join(self.archive_dir, 'test_cycle_%d.jsonl.gz' % cycle_id)
+            # Appending adds a gzip member per run; readers see one stream
+            archive = gzip.open(path, 'ab')
+        batch_ids = set()
+        pruned = 0
+        try:
+            while True:
+                execution_ids = [row[0] for row in connection.execute(
+                    select([self.links.c.case_execution_id])
+                    .where(self.links.c.test_cycle_id==cycle_id)
+                    .order_by(self.links.c.case_execution_id)
+                    .limit(self.chunk_size))]
+                if not execution_ids:
+                    break
+                if archive is not None:
+                    self.archive(archive, cycle, execution_ids)
+                batch_ids.update(self.delete(cycle_id, execution_ids))
+                pruned += len(execution_ids)
+                if self.pause:
+                    time.sleep(self.pause)
+        finally:
+            if archive is not None:
+                archive.close()
+        transaction = connection.begin()
+        try:
+            self.delete_batches(batch_ids)
+            connection.execute(self.cycles.delete().where(self.cycles.c.id==cycle_id))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return pruned
+    
+    def archive(self, archive, cycle, execution_ids):
+        
+        connection = self.connection
+        Execution = self.executions
+        parts = {}
+        for execution_id, part in connection.execute(
+                select([self.parts.c.case_execution_id, self.parts.c.part])
+                .where(self.parts.c.case_execution_id.in_(execution_ids))
+                .order_by(self.parts.c.id)):
+            parts.setdefault(execution_id, []).append(part)
+        query = (select([Execution, self.cases.c.label, self.addresses.c.parts.label('address')])
+                 .select_from(Execution.outerjoin(self.cases, self.cases.c.id==Execution.c.case_id)
+                              .outerjoin(self.addresses,
+                                         self.addresses.c.id==Execution.c.address_id))
+                 .where(Execution.c.id.in_(execution_ids))
+                 .order_by(Execution.c.id))
+        for row in connection.execute(query):
+            address = json.loads(row.address) if row.address is not None else parts.get(row.id, [])
+            archive.write(json.dumps({'test_cycle_id' : cycle.id,
+                                      'test_cycle_name' : cycle.name,
+                                      'execution_batch_id' : row.execution_batch_id,
+                                      'case_execution_id' : row.id,
+                                      'case' : row.label,
+                                      'address' : address,
+                                      'description' : row.description,
+                                      'result' : row.result,
+                                      'start_time' : _isoformat(row.start_time),
+                                      'end_time' : _isoformat(row.end_time)}) + '\n')
+        # Archived before the rows go; a crash in between archives them twice
+        archive.flush()
+        os.fsync(archive.fileobj.fileno())
+    
+    def delete(self, cycle_id, execution_ids):
+        
+        connection = self.connection
+        transaction = connection.begin()
+        try:
+            connection.execute(self.links.delete()
+                               .where(self.links.c.test_cycle_id==cycle_id)
+                               .where(self.links.c.case_execution_id.in_(execution_ids)))
+            # Executions also linked to a cycle that is being kept stay
+            kept = set(row[0] for row in connection.execute(
+                select([self.links.c.case_execution_id])
+                .where(self.links.c.case_execution_id.in_(execution_ids))))
+            orphans = [id_ for id_ in execution_ids if id_ not in kept]
+            batch_ids = set()
+            if orphans:
+                batch_ids.update(row[0] for row in connection.execute(
+                    select([self.executions.c.execution_batch_id])
+                    .where(self.executions.c.id.in_(orphans))
+                    .distinct()))
+                connection.execute(self.parts.delete()
+                                   .where(self.parts.c.case_execution_id.in_(orphans)))
+                connection.execute(self.executions.delete()
+                                   .where(self.executions.c.id.in_(orphans)))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        return batch_ids
+    
+    def delete_batches(self, batch_ids):
+        
+        connection = self.connection
+        for batch_id in batch_ids:
+            if connection.execute(select([self.executions.c.id])
+                                  .where(self.executions.c.execution_batch_id==batch_id)
+                                  .limit(1)).first() is not None:
+                continue
+            default_case_id = connection.execute(select([self.batches.c.default_case_id])
+                                                 .where(self.batches.c.id==batch_id)).scalar()
+            connection.execute(self.batches.delete().where(self.batches.c.id==batch_id))
+            if default_case_id is not None:
+                connection.execute(self.cases.delete().where(self.cases.c.id==default_case_id))
+
+
+def prune(engine, older_than, archive_dir=None, chunk_size=1000, pause=0,
+          declarative_base=Base):
+    """Archives and deletes every :term:`Test Cycle` whose latest
+    :term:`Case Execution` started more than ``older_than`` ago, along with its
+    executions, their address parts and cycle links, and the
+    :term:`Execution Batch`\ es left without executions.
+    
+    :param engine: Engine for the reporting database.
+    :type engine: `SQLAlchemy engine
+        <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+    :param older_than: Age of the cycles to prune.
+    :type older_than: ``datetime.timedelta``
+    :param archive_dir: Directory to write ``test_cycle_<id>.jsonl.gz`` archives
+        to, one JSON object per :term:`Case Execution`\ .  If ``None``, nothing
+        is archived.  Defaults to ``None``.
+    :type archive_dir: ``string`` or ``None``
+    :param chunk_size: Number of executions archived and deleted per
+        transaction.  Defaults to ``1000``.
+    :type chunk_size: ``int``
+    :param pause: Seconds to sleep between chunks, to leave room for live
+        writers.  Defaults to ``0``.
+    :type pause: ``float``
+    
+    :returns: A ``dict`` mapping pruned :term:`Test Cycle` ids to the number of
+        executions pruned from each.
+    """
+    
+    from sneeze.database.interface import load_models
+    models = load_models(declarative_base)
+    if archive_dir is not None and not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    connection = engine.connect()
+    pruned = {}
+    try:
+        pruner = _Pruner(connection, models, archive_dir, chunk_size, pause)
+        for cycle_id in expired_cycle_ids(connection, models, datetime.now() - older_than):
+            pruned[cycle_id] = pruner.cycle(cycle_id)
+            log.info('Pruned test cycle %d, %d executions.', cycle_id, pruned[cycle_id])
+    finally:
+        connection.close()
+    return pruned
+
+
+def main(argv=None):
+    
+    parser = OptionParser(usage='sneeze-prune-db [options] CONFIG_STRING')
+    parser.add_option('--older-than-days', type=float, dest='older_than_days',
+                      help='Prune test cycles whose last execution started this many days ago.')
+    parser.add_option('--archive-dir', dest='archive_dir',
+                      help='Archive pruned executions to gzipped JSON lines files in this directory.')
+    parser.add_option('--no-archive', action='store_true', default=False, dest='no_archive',
+                      help='Delete without archiving.')
+    parser.add_option('--chunk-size', type=int, default=1000, dest='chunk_size')
+    parser.add_option('--pause', type=float, default=0, dest='pause',
+                      help='Seconds to sleep between chunks.')
+    options, args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if len(args) != 1 or options.older_than_days is None:
+        parser.error('a connection string and --older-than-days are required')
+    if not options.archive_dir and not options.no_archive:
+        parser.error('give --archive-dir, or --no-archive to delete without archiving')
+    logging.basicConfig(level=logging.INFO)
+    pruned = prune(create_engine(args[0]), timedelta(days=options.older_than_days),
+                   archive_dir=None if options.no_archive else options.archive_dir,
+                   chunk_size=options.chunk_size, pause=options.pause)
+    print 'Pruned %d test cycles, %d executions.' % (len(pruned), sum(pruned.values()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
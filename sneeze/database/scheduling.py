@@ -0,0 +1,187 @@
+'''Statistics for ordering and sharding test runs, taken from the
+:term:`Case Execution` history of each :term:`Test Case` in the reporting
+database.  Statistics are keyed by case label and can be cached in a local
+JSON file between runs, so that most runs do not query the database at all.
+'''
+
+
+from sqlalchemy import select, func, case
+import os, json, time, logging, tempfile
+
+
+log = logging.getLogger(__name__)
+
+
+def cached(path, ttl, compute):
+    """Returns the ``dict`` stored in the JSON file at ``path`` if the file is
+    less than ``ttl`` seconds old.  Otherwise calls ``compute`` and stores the
+    ``dict`` it returns there first, creating the directory if needed.  A cache
+    that cannot be read or written is logged and otherwise ignored.
+    
+    :param path: Path of the cache file, or ``None`` to always compute.
+    :type path: ``string`` or ``None``
+    :param ttl: Maximum age of the cache file, in seconds.
+    :type ttl: ``float``
+    :param compute: Called without arguments to produce the statistics.
+    :type compute: callable returning a ``dict``
+    """
+    
+    if path is None:
+        return compute()
+    try:
+        if time.time() - os.path.getmtime(path) < ttl:
+            with open(path) as cache_file:
+                return json.load(cache_file)
+    except OSError:
+        pass
+    except (IOError, ValueError) as e:
+        log.warning('Ignoring unreadable cache %s: %s', path, e)
+    values = compute()
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another run may have just created it
+            if not os.path.isdir(directory):
+                raise
+        # Written aside and renamed into place, so concurrent runs never read half a file
+        descriptor, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, 'w') as cache_file:
+            json.dump(values, cache_file)
+        os.rename(temporary, path)
+    except (OSError, IOError) as e:
+        log.warning('Could not write cache %s: %s', path, e)
+    return values
+
+
+def median_durations(session, models, labels, since=None, history=20, chunk_size=500):
+    """Returns the median duration, in seconds, of the last ``history``
+    completed :term:`Case Execution`\ s of each :term:`Test Case` with one of
+    the given labels, keyed by label.  Labels without completed executions are
+    left out.  Uses one query per ``chunk_size`` labels, streaming rows rather
+    than loading executions.  ``since`` bounds the rows read in the query
+    itself, which matters once a suite has a long history.
+    
+    :param session: The session to query with.
+    :type session: ``SQLAlchemy Session``
+    :param models: The ``Tissue``\ 's ``db_models``\ .
+    :type models: ``dict``
+    :param labels: Labels of the :term:`Test Case`\ s about to be run.
+    :type labels: iterable of ``string``\ s
+    :param since: If given, only executions started since then are read.
+    :type since: ``datetime.datetime`` or ``None``
+    :param history: Number of recent executions to take the median of.
+    :type history: ``int``
+    :param chunk_size: Maximum number of labels per query.
+    :type chunk_size: ``int``
+    
+    :returns: A ``dict`` of ``float`` seconds keyed by label.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    Case = models['Case'].__table__
+    labels = sorted(set(labels))
+    durations = {}
+    for start in xrange(0, len(labels), chunk_size):
+        query = (select([Case.c.label, Execution.c.start_time, Execution.c.end_time])
+                 .select_from(Execution.join(Case, Case.c.id==Execution.c.case_id))
+                 .where(Case.c.label.in_(labels[start:start + chunk_size]))
+                 .where(Execution.c.start_time!=None)
+                 .where(Execution.c.end_time!=None)
+                 .order_by(Execution.c.id.desc()))
+        if since is not None:
+            query = query.where(Execution.c.start_time >= since)
+        for label, start_time, end_time in session.execute(query):
+            recent = durations.setdefault(label, [])
+            if len(recent) < history:
+                recent.append((end_time - start_time).total_seconds())
+    return dict((label, _median(recent)) for label, recent in durations.iteritems())
+
+
+def failure_rates(session, models, since=None):
+    """Returns the fraction of the passed or failed :term:`Case Execution`\ s
+    of each :term:`Test Case` that failed, keyed by label, from one aggregate
+    query.  Cases that did not fail are left out, which keeps the result small
+    for large suites.
+    
+    :param session: The session to query with.
+    :type session: ``SQLAlchemy Session``
+    :param models: The ``Tissue``\ 's ``db_models``\ .
+    :type models: ``dict``
+    :param since: If given, only executions started since then are counted.
+    :type since: ``datetime.datetime`` or ``None``
+    
+    :returns: A ``dict`` of ``float`` fractions keyed by label.
+    """
+    
+    Execution = models['CaseExecution'].__table__
+    Case = models['Case'].__table__
+    failures = func.sum(case([(Execution.c.result=='FAIL', 1)], else_=0))
+    query = (select([Case.c.label, failures, func.count(Execution.c.id)])
+             .select_from(Execution.join(Case, Case.c.id==Execution.c.case_id))
+             .where(Execution.c.result.in_(['PASS', 'FAIL']))
+             .group_by(Case.c.label)
+             .having(failures > 0))
+    if since is not None:
+        query = query.where(Execution.c.start_time >= since)
+    return dict((label, float(failed) / total)
+                for label, failed, total in session.execute(query))
+
+
+def _median(values):
+    
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimated_durations(labels, durations):
+    """Returns the duration of each label in ``labels``\ , in order.  Tests
+    without a recorded duration are estimated at the median of the ones that
+    have one, or at one second if none do, so that they still spread evenly.
+    """
+    
+    known = [durations[label] for label in labels if label in durations]
+    default = _median(known) if known else 1.0
+    return [durations.get(label, default) for label in labels]
+
+
+def assign_shards(weights, count):
+    """Splits items of the given weights into ``count`` shards of nearly equal
+    total weight, placing the heaviest remaining item on the lightest shard.
+    The split depends only on the weights and their order, so every host
+    running a shard of the same suite computes the same one.
+    
+    :param weights: The weight, such as the duration, of each item.
+    :type weights: ``list`` of numbers
+    :param count: Number of shards.
+    :type count: ``int``
+    
+    :returns: A ``list`` with the shard, from ``0``\ , of each item.
+    """
+    
+    loads = [(0.0, 0, shard) for shard in xrange(count)]
+    shards = [None] * len(weights)
+    for index in sorted(xrange(len(weights)), key=lambda index: (-weights[index], index)):
+        load, items, shard = min(loads)
+        loads[shard] = (load + weights[index], items + 1, shard)
+        shards[index] = shard
+    return shards
+
+
+def parse_shard(spec):
+    """Parses a ``'N/M'`` shard specification, the ``N``\ th of ``M`` shards
+    counting from ``1``\ , into a ``(N - 1, M)`` ``tuple``\ .  Raises
+    ``ValueError`` if it is malformed.
+    """
+    
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError('Shards are given as N/M, not %r.' % (spec,))
+    if not 1 <= index <= count:
+        raise ValueError('Shard %d/%d does not exist.' % (index, count))
+    return index - 1, count
@@ -0,0 +1,329 @@
+'''A spool is a local SQLite database, in WAL mode, with the same schema as the
+reporting database.  A :doc:`Tissue <tissue>` pointed at a spool records at
+local disk speed, and the spooled :term:`Test Cycle`\ s, :term:`Execution Batch`\ es,
+:term:`Case Execution`\ s and address parts are copied to the reporting
+database afterwards, either when the Tissue exits or with::
+    
+    sneeze-upload-spool SPOOL_PATH CONFIG_STRING
+
+Ids are remapped on upload; :term:`Test Case`\ s are matched by label.  Rows of
+models added by plugins are not uploaded.
+'''
+
+
+from sqlalchemy import (MetaData, Table, Column, Integer, DateTime, create_engine, event,
+                        select, func)
+from sqlalchemy.orm import sessionmaker
+from optparse import OptionParser
+from datetime import datetime
+from sneeze.database.models import Base
+from sneeze.database.migrations import create_schema
+import sys, logging
+
+
+log = logging.getLogger(__name__)
+
+_spool_metadata = MetaData()
+
+# Spooled cycles and the reporting database cycles they were uploaded to, or
+# were standing in for when the run was given a --test-cycle-id
+spool_cycle = Table('sneeze_spool_cycle', _spool_metadata,
+                    Column('spool_id', Integer, primary_key=True),
+                    Column('target_id', Integer))
+
+spool_batch = Table('sneeze_spool_batch', _spool_metadata,
+                    Column('spool_id', Integer, primary_key=True),
+                    Column('target_id', Integer),
+                    Column('uploaded', DateTime))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def spool_engine(path):
+    """Returns an engine for the spool at ``path``\ , in WAL mode."""
+    
+    # Multiprocess workers may share a spool, so wait on their write locks
+    engine = create_engine('sqlite:///' + path, connect_args={'timeout' : 60})
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def prepare_spool(engine, target_cycle_id=None, declarative_base=Base):
+    """Creates the spool's tables.  If ``target_cycle_id`` is given, returns the
+    id of the spooled :term:`Test Cycle` standing in for that reporting database
+    cycle, creating it if needed, so that it can be passed to a spooling Tissue
+    as ``test_cycle_id``\ .
+    """
+    
+    from sneeze.database.interface import load_models
+    TestCycle = load_models(declarative_base)['TestCycle'].__table__
+    create_schema(engine, declarative_base)
+    _spool_metadata.create_all(engine)
+    if not target_cycle_id:
+        return None
+    connection = engine.connect()
+    try:
+        spool_id = connection.execute(select([spool_cycle.c.spool_id])
+                                      .where(spool_cycle.c.target_id==target_cycle_id)).scalar()
+        if spool_id is None:
+            transaction = connection.begin()
+            spool_id = connection.execute(TestCycle.insert().values(name='', description='')
+                                          ).inserted_primary_key[0]
+            connection.execute(spool_cycle.insert().values(spool_id=spool_id,
+                                                           target_id=target_cycle_id))
+            transaction.commit()
+        return spool_id
+    finally:
+        connection.close()
+
+
+def _chunks(items, size):
+    
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+class _Upload(object):
+    
+    def __init__(self, spool, models, chunk_size):
+        
+        self.spool = spool
+        self.chunk_size = chunk_size
+        self.cases = models['Case'].__table__
+        self.cycles = models['TestCycle'].__table__
+        self.batches = models['ExecutionBatch'].__table__
+        self.executions = models['CaseExecution'].__table__
+        self.parts = models['CaseExecutionAddressPart'].__table__
+        self.links = models['TestCycleCaseExecution'].__table__
+        self.addresses = models['Address'].__table__
+        self.address_map = {}
+        self.ExecutionBatch = models['ExecutionBatch']
+        self.cycle_map = dict(spool.execute(select([spool_cycle.c.spool_id, spool_cycle.c.target_id])).fetchall())
+    
+    def batch(self, batch, session):
+        
+        # The ORM creates and labels the batch's default case in the target
+        execution_batch = self.ExecutionBatch(environment=batch.environment, host=batch.host,
+                                              arguments=batch.arguments, start_time=batch.start_time)
+        execution_batch.end_time = batch.end_time
+        session.add(execution_batch)
+        session.flush()
+        target_batch_id = execution_batch.id
+        case_map = {batch.default_case_id : execution_batch.default_case_id}
+        new_cycles = {}
+        last_spool_id, last_target_id = 0, 0
+        while True:
+            executions = self.spool.execute(select([self.executions])
+                                            .where(self.executions.c.execution_batch_id==batch.id)
+                                            .where(self.executions.c.id > last_spool_id)
+                                            .order_by(self.executions.c.id)
+                                            .limit(self.chunk_size)).fetchall()
+            if not executions:
+                break
+            spool_ids = [execution.id for execution in executions]
+            self.map_cases(session, case_map, set(execution.case_id for execution in executions))
+            self.map_addresses(session, set(execution.address_id for execution in executions))
+            session.execute(self.executions.insert(),
+                            [{'case_id' : case_map.get(execution.case_id),
+                              'execution_batch_id' : target_batch_id,
+                              'address_id' : self.address_map.get(execution.address_id),
+                              'description' : execution.description,
+                              'result' : execution.result,
+                              'start_time' : execution.start_time,
+                              'end_time' : execution.end_time}
+                             for execution in executions])
+            # The target batch is new, so its executions past the last id are
+            # exactly the ones just inserted, in order
+            target_ids = [row[0] for row in
+                          session.execute(select([self.executions.c.id])
+                                          .where(self.executions.c.execution_batch_id==target_batch_id)
+                                          .where(self.executions.c.id > last_target_id)
+                                          .order_by(self.executions.c.id))]
+            execution_map = dict(zip(spool_ids, target_ids))
+            parts = self.spool.execute(select([self.parts.c.case_execution_id, self.parts.c.part])
+                                       .where(self.parts.c.case_execution_id.in_(spool_ids))
+                                       .order_by(self.parts.c.id)).fetchall()
+            if parts:
+                session.execute(self.parts.insert(),
+                                [{'case_execution_id' : execution_map[part.case_execution_id],
+                                  'part' : part.part}
+                                 for part in parts])
+            links = self.spool.execute(select([self.links])
+                                       .where(self.links.c.case_execution_id.in_(spool_ids))).fetchall()
+            if links:
+                for link in links:
+                    self.map_cycle(session, new_cycles, link.test_cycle_id)
+                session.execute(self.links.insert(),
+                                [{'test_cycle_id' : self.target_cycle(new_cycles, link.test_cycle_id),
+                                  'case_execution_id' : execution_map[link.case_execution_id],
+                                  'include_in_reporting' : link.include_in_reporting}
+                                 for link in links])
+            last_spool_id, last_target_id = spool_ids[-1], target_ids[-1]
+        return target_batch_id, new_cycles
+    
+    def target_cycle(self, new_cycles, spool_cycle_id):
+        
+        try:
+            return self.cycle_map[spool_cycle_id]
+        except KeyError:
+            return new_cycles[spool_cycle_id]
+    
+    def map_cycle(self, session, new_cycles, spool_cycle_id):
+        
+        if spool_cycle_id in self.cycle_map or spool_cycle_id in new_cycles:
+            return
+        cycle = self.spool.execute(self.cycles.select()
+                                   .where(self.cycles.c.id==spool_cycle_id)).first()
+        new_cycles[spool_cycle_id] = session.execute(self.cycles.insert()
+                                                     .values(name=cycle.name,
+                                                             description=cycle.description)
+                                                     ).inserted_primary_key[0]
+    
+    def map_cases(self, session, case_map, spool_case_ids):
+        
+        spool_case_ids = [id_ for id_ in spool_case_ids if id_ is not None and id_ not in case_map]
+        labels = {}
+        for chunk in _chunks(spool_case_ids, 500):
+            for id_, label in self.spool.execute(select([self.cases.c.id, self.cases.c.label])
+                                                 .where(self.cases.c.id.in_(chunk))):
+                labels.setdefault(label, []).append(id_)
+        
+        def load_labels():
+            
+            for chunk in _chunks(labels, 500):
+                query = (select([self.cases.c.label, func.min(self.cases.c.id)])
+                         .where(self.cases.c.label.in_(chunk))
+                         .group_by(self.cases.c.label))
+                for label, target_id in session.execute(query).fetchall():
+                    for id_ in labels.pop(label):
+                        case_map[id_] = target_id
+        
+        load_labels()
+        if labels:
+            session.execute(self.cases.insert(), [{'label' : label} for label in labels])
+            load_labels()
+    
+    def map_addresses(self, session, spool_address_ids):
+        
+        spool_address_ids = [id_ for id_ in spool_address_ids
+                             if id_ is not None and id_ not in self.address_map]
+        digests = {}
+        for chunk in _chunks(spool_address_ids, 500):
+            for id_, digest, parts in self.spool.execute(select([self.addresses.c.id,
+                                                                 self.addresses.c.digest,
+                                                                 self.addresses.c.parts])
+                                                         .where(self.addresses.c.id.in_(chunk))):
+                digests.setdefault(digest, (parts, []))[1].append(id_)
+        
+        def load_digests():
+            
+            for chunk in _chunks(digests, 500):
+                query = (select([self.addresses.c.digest, func.min(self.addresses.c.id)])
+                         .where(self.addresses.c.digest.in_(chunk))
+                         .group_by(self.addresses.c.digest))
+                for digest, target_id in session.execute(query).fetchall():
+                    for id_ in digests.pop(digest)[1]:
+                        self.address_map[id_] = target_id
+        
+        load_digests()
+        if digests:
+            session.execute(self.addresses.insert(), [{'digest' : digest, 'parts' : parts}
+                                                      for digest, (parts, ids) in digests.iteritems()])
+            load_digests()
+
+
+def upload(spool_engine, target_engine, declarative_base=Base, include_unfinished=False):
+    """Copies every finished spooled :term:`Execution Batch` that has not been
+    uploaded yet, with its :term:`Case Execution`\ s, address parts and
+    :term:`Test Cycle` links, to the reporting database.  Each batch is uploaded
+    in one transaction and marked as uploaded in the spool once that
+    transaction commits, so an interrupted upload can be rerun; a batch may be
+    uploaded twice if the process dies between the two.
+    
+    Batches without an end time are still being recorded, by another run on
+    the same spool, and are left for a later upload, as executions recorded
+    after a batch is uploaded are never copied.
+    
+    :param spool_engine: Engine for the spool.
+    :type spool_engine: `SQLAlchemy engine
+        <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+    :param target_engine: Engine for the reporting database.
+    :type target_engine: `SQLAlchemy engine
+        <http://docs.sqlalchemy.org/en/rel_0_8/core/connections.html#sqlalchemy.engine.Engine>`_
+    :param include_unfinished: If ``True``, batches without an end time are
+        uploaded too, for runs that died before finishing.  Defaults to ``False``.
+    :type include_unfinished: ``bool``
+    
+    :returns: A ``dict`` mapping spooled :term:`Execution Batch` ids to their ids
+        in the reporting database.
+    """
+    
+    from sneeze.database.interface import load_models
+    models = load_models(declarative_base)
+    _spool_metadata.create_all(spool_engine)
+    spool = spool_engine.connect()
+    Session = sessionmaker(bind=target_engine)
+    uploaded = {}
+    try:
+        job = _Upload(spool, models, 5000)
+        done = set(row[0] for row in spool.execute(select([spool_batch.c.spool_id])))
+        query = job.batches.select().order_by(job.batches.c.id)
+        if not include_unfinished:
+            query = query.where(job.batches.c.end_time!=None)
+        batches = [batch for batch in spool.execute(query).fetchall() if batch.id not in done]
+        for batch in batches:
+            session = Session()
+            try:
+                target_batch_id, new_cycles = job.batch(batch, session)
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+            job.cycle_map.update(new_cycles)
+            transaction = spool.begin()
+            for spool_id, target_id in new_cycles.iteritems():
+                spool.execute(spool_cycle.insert().values(spool_id=spool_id, target_id=target_id))
+            spool.execute(spool_batch.insert().values(spool_id=batch.id, target_id=target_batch_id,
+                                                      uploaded=datetime.now()))
+            transaction.commit()
+            log.info('Uploaded spooled execution batch %d as %d.', batch.id, target_batch_id)
+            uploaded[batch.id] = target_batch_id
+    finally:
+        spool.close()
+    return uploaded
+
+
+def main(argv=None):
+    
+    parser = OptionParser(usage='sneeze-upload-spool [options] SPOOL_PATH CONFIG_STRING')
+    parser.add_option('--include-unfinished', action='store_true', default=False,
+                      dest='include_unfinished',
+                      help=('Also upload execution batches that have not ended, such as those of '
+                            'runs that died.  Executions they record afterwards are not uploaded.'))
+    options, args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if len(args) != 2:
+        parser.error('a spool path and a connection string are required')
+    logging.basicConfig(level=logging.INFO)
+    from sneeze.database.interface import load_models
+    from sneeze.database.migrations import upgrade
+    target_engine = create_engine(args[1])
+    load_models(Base)
+    Base.metadata.create_all(target_engine)
+    upgrade(target_engine)
+    uploaded = upload(spool_engine(args[0]), target_engine,
+                      include_unfinished=options.include_unfinished)
+    print 'Uploaded %d execution batches.' % len(uploaded)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
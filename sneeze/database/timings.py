@@ -0,0 +1,106 @@
+'''Timers for the work Sneeze itself adds to each test.  A :doc:`Tissue <tissue>`
+given a :class:`Timings` instance times its case events, sessions, transactions
+and plugin hooks, and reports the distributions when it exits.  Without one,
+none of the timed code paths are wrapped.
+'''
+
+
+from threading import Lock
+from timeit import default_timer
+from functools import wraps
+import math
+
+
+# Durations are counted in buckets 2% wide, which bounds the error of the
+# reported percentiles without keeping every sample
+_BUCKET_BASE = math.log(1.02)
+_SMALLEST = 1e-7
+
+
+class Histogram(object):
+    """Counts durations, in seconds, in logarithmic buckets."""
+    
+    def __init__(self):
+        
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, seconds):
+        
+        bucket = int(math.log(max(seconds, _SMALLEST) / _SMALLEST) / _BUCKET_BASE)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the ``fraction``
+        percentile, e.g. ``0.95``\ , or ``0.0`` if nothing was counted.
+        """
+        
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_SMALLEST * math.exp((bucket + 1) * _BUCKET_BASE), self.max)
+        return 0.0
+    
+    def as_dict(self):
+        
+        return {'count' : self.count,
+                'total' : self.total,
+                'mean' : self.total / self.count if self.count else 0.0,
+                'max' : self.max,
+                'p50' : self.percentile(0.5),
+                'p95' : self.percentile(0.95),
+                'p99' : self.percentile(0.99)}
+
+
+class Timings(object):
+    """A set of named :class:`Histogram`\ s, safe to add to from several
+    threads.
+    """
+    
+    def __init__(self):
+        
+        self.histograms = {}
+        self._lock = Lock()
+    
+    def add(self, name, seconds):
+        
+        with self._lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+    
+    def timed(self, name, function):
+        """Returns ``function`` wrapped so that each call's duration is added
+        to the ``name`` histogram.
+        """
+        
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            
+            started = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, default_timer() - started)
+        
+        return timed_function
+    
+    def as_dict(self):
+        """Returns a ``dict`` of histogram summaries keyed by name.  Each summary
+        has ``count``\ , ``total``\ , ``mean``\ , ``max``\ , ``p50``\ , ``p95`` and
+        ``p99`` keys, all durations in seconds.
+        """
+        
+        with self._lock:
+            return dict((name, histogram.as_dict())
+                        for name, histogram in self.histograms.iteritems())
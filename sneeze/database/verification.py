@@ -0,0 +1,131 @@
+'''Helpers that keep the password and token hashing done by ``User`` and
+``UserToken`` off the hot path.  A :class:`VerificationCache` remembers recent
+verification results, and a thread or process pool can run the hashing so
+that an event loop serving many callers is not blocked by it.
+'''
+
+
+from threading import Lock
+from sneeze.database.cache import LRUCache
+import hashlib, time
+
+
+class VerificationCache(object):
+    """A bounded, thread safe cache of verification results that expire after
+    ``ttl`` seconds.  Entries are keyed on the kind and id of the verified
+    object and a SHA-256 digest of the stored hash and the presented value, so
+    a changed password or a different value never hits a stale entry.
+    """
+    
+    def __init__(self, size=10000, ttl=300):
+        """
+        :param size: Maximum number of results to keep.  Defaults to ``10000``.
+        :type size: ``int``
+        :param ttl: Seconds a result is kept for.  Defaults to ``300``.
+        :type ttl: ``float``
+        """
+        
+        self.ttl = ttl
+        self.results = LRUCache(size)
+        self._lock = Lock()
+    
+    def key(self, kind, id_, crypt, value):
+        
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return (kind, id_, hashlib.sha256('%s\0%s' % (crypt, value)).hexdigest())
+    
+    def get(self, key):
+        """Returns the cached result for ``key``\ , or ``None`` if there is no
+        unexpired one.
+        """
+        
+        with self._lock:
+            entry = self.results.get(key)
+            if entry is None:
+                return None
+            result, expires = entry
+            if expires < time.time():
+                self.results.discard(key)
+                return None
+            return result
+    
+    def set(self, key, result):
+        
+        with self._lock:
+            self.results[key] = (result, time.time() + self.ttl)
+    
+    def discard(self, key):
+        
+        with self._lock:
+            self.results.discard(key)
+
+
+class _Ready(object):
+    """An already completed result, for cache hits when a pool is in use.
+    Offers the ``get`` of ``multiprocessing`` results and the ``result`` of
+    ``concurrent.futures`` futures.
+    """
+    
+    def __init__(self, value):
+        
+        self.value = value
+    
+    def get(self, timeout=None):
+        
+        return self.value
+    
+    def result(self, timeout=None):
+        
+        return self.value
+    
+    def ready(self):
+        
+        return True
+    
+    def done(self):
+        
+        return True
+
+
+def check(scheme, value, crypt):
+    """Verifies ``value`` against ``crypt`` with the named ``passlib`` scheme.
+    A module level function so that process pools can run it.
+    """
+    
+    # passlib is only imported once something is verified
+    from passlib import hash as schemes
+    return getattr(schemes, scheme).verify(value, crypt)
+
+
+def verify(scheme, value, crypt, cache=None, key=None, pool=None):
+    """Verifies ``value`` against ``crypt``\ , consulting and filling ``cache``
+    under ``key`` if both are given.
+    
+    :param pool: If given, the hashing runs in it and a result object is
+        returned instead of a ``bool``\ .  Either a ``multiprocessing`` pool
+        (``Pool`` or ``ThreadPool``\ ), whose ``apply_async`` result has a
+        ``get`` method, or a ``concurrent.futures`` executor, whose future has
+        a ``result`` method.  Cache hits return an already completed result.
+    
+    :returns: ``True`` if ``value`` matches, or a result object if ``pool`` was
+        given.
+    """
+    
+    cached = cache.get(key) if cache is not None and key is not None else None
+    if cached is not None:
+        return _Ready(cached) if pool is not None else cached
+    store = cache is not None and key is not None
+    if pool is None:
+        result = check(scheme, value, crypt)
+        if store:
+            cache.set(key, result)
+        return result
+    if hasattr(pool, 'submit'):
+        future = pool.submit(check, scheme, value, crypt)
+        if store:
+            future.add_done_callback(lambda done: done.exception() is None
+                                     and cache.set(key, done.result()))
+        return future
+    return pool.apply_async(check, (scheme, value, crypt),
+                            callback=(lambda result: cache.set(key, result)) if store else None)
@@ -0,0 +1,36 @@
+'''Entry point lookup for Sneeze plugins.  Uses ``importlib.metadata`` (or its
+``importlib_metadata`` backport) where available, which reads installed
+distributions' metadata without the import time cost of ``pkg_resources``\ ,
+and falls back to ``pkg_resources`` otherwise.  Results are cached per group.
+'''
+
+
+_groups = {}
+
+
+def _scan(group):
+    
+    try:
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            from importlib_metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group=group))
+    found = entry_points()
+    try:
+        return list(found.select(group=group))
+    except AttributeError:
+        # Older versions return a dict of groups
+        return list(found.get(group, ()))
+
+
+def iter_entry_points(group):
+    """Returns the entry points in ``group``\ ; each has a ``load`` method."""
+    
+    try:
+        return _groups[group]
+    except KeyError:
+        entry_points = _groups[group] = _scan(group)
+        return entry_points
@@ -12,10 +12,114 @@ and attaches them to the Tissue.
 
 
 from nose.plugins import Plugin
-from sneeze.database.interface import Tissue
-import os, sys, socket, pkg_resources
+from sneeze.entry_points import iter_entry_points
+import os, sys, socket, json, hashlib
+from threading import Thread
 from nose.exc import SkipTest, DeprecatedTest
 from multiprocessing import current_process
+from datetime import datetime, timedelta
+# The database modules, and with them SQLAlchemy and passlib, are imported in
+# configure, once Sneeze is known to be enabled
+
+
+# Set in the parent before nose multiprocess forks its workers, which inherit it
+_aggregator = None
+
+# Likewise resolved once in the parent
+_host = None
+
+HOST_LOOKUP_TIMEOUT = 2.0
+
+def resolve_host(timeout=HOST_LOOKUP_TIMEOUT):
+    '''Returns this machine's fully qualified host name, looked up once per run.
+    If the reverse DNS lookup takes longer than ``timeout`` seconds or fails,
+    the plain host name is used instead.
+    '''
+    
+    global _host
+    if _host is None:
+        name = socket.gethostname()
+        found = []
+        
+        def lookup():
+            
+            try:
+                found.append(socket.gethostbyaddr(name)[0])
+            except socket.error:
+                pass
+        
+        thread = Thread(target=lookup, name='sneeze-host-lookup')
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        _host = found[0] if found else name
+    return _host
+
+def _collect_tests(suite):
+    '''Returns the individual tests in a nose suite.  Lazy suites are loaded and
+    their tests stored back on them, so the suite still runs as it would have.
+    '''
+    
+    try:
+        tests = list(suite._tests)
+    except AttributeError:
+        return [suite]
+    suite._tests = tests
+    collected = []
+    for test in tests:
+        collected.extend(_collect_tests(test))
+    return collected
+
+
+def _case_label(test):
+    
+    return '.'.join(test.address()[1:])
+
+
+def _prune_suite(suite, keep):
+    '''Removes the tests whose ids are not in ``keep`` from a suite whose tests
+    were collected with :func:`_collect_tests`\ , along with any suites left
+    empty.  Returns whether anything of ``suite`` is left.
+    '''
+    
+    try:
+        tests = list(suite._tests)
+    except AttributeError:
+        return id(suite) in keep
+    tests = [test for test in tests if _prune_suite(test, keep)]
+    suite._tests = tests
+    return bool(tests)
+
+
+def _order_suite(suite, keys, combine):
+    '''Orders the tests of a suite whose tests were collected with
+    :func:`_collect_tests`\ , and each suite within it, by descending key.  The
+    keys of tests are given by id in ``keys``\ , and the key of a suite is
+    ``combine`` applied to the keys of its tests.  Suites keep their tests
+    together, so fixtures still run once.  Returns the key of ``suite``\ .
+    '''
+    
+    try:
+        tests = list(suite._tests)
+    except AttributeError:
+        return keys[id(suite)]
+    children = dict((id(test), _order_suite(test, keys, combine)) for test in tests)
+    tests.sort(key=lambda test: children[id(test)], reverse=True)
+    suite._tests = tests
+    return combine(children.values())
+
+
+def _not_run(result):
+    
+    # Stands in for a test of another shard
+    pass
+
+
+def _run_order_key(keys):
+    
+    # A suite runs as early as its likeliest failure, and as long as all its tests
+    return (max([failure_rate for failure_rate, duration in keys] or [0]),
+            sum(duration for failure_rate, duration in keys))
 
 
 class Sneeze(Plugin):
@@ -57,6 +161,14 @@ class Sneeze(Plugin):
                           metavar='EXECUTION_ID_LIST',
                           type=int,
                           help='Case execution id to base rerun upon.')
+        parser.add_option('--rerun-failures-from-cycle',
+                          action='store',
+                          default=0,
+                          dest='rerun_failures_cycle',
+                          metavar='CYCLE_ID',
+                          type=int,
+                          help=('Rerun the tests whose last execution in test cycle CYCLE_ID failed.  '
+                                'Runs under that cycle unless another one is given.'))
         parser.add_option('--pocket-change-host',
                           action='store',
                           default=env.get('pocket_change_host', ''),
@@ -87,7 +199,202 @@ class Sneeze(Plugin):
                           dest='pocket_change_environment_envvar',
                           metavar='ENVIRONMENT_VAR_NAME',
                           help='Name of environment variable to record as the test environment value.')
-        for add_options in pkg_resources.iter_entry_points(group='nose.plugins.sneeze.plugins.add_options'):
+        parser.add_option('--reporting-write-behind',
+                          action='store_true',
+                          default=bool(env.get('sneeze_write_behind', '')),
+                          dest='reporting_write_behind',
+                          help=('Record case executions from a background thread instead of '
+                                'blocking each test on the reporting database.'))
+        parser.add_option('--reporting-queue-size',
+                          action='store',
+                          default=1000,
+                          dest='reporting_queue_size',
+                          metavar='SIZE',
+                          type=int,
+                          help='Maximum number of case events waiting to be written in write behind mode.')
+        parser.add_option('--reporting-batch-size',
+                          action='store',
+                          default=100,
+                          dest='reporting_batch_size',
+                          metavar='SIZE',
+                          type=int,
+                          help='Maximum number of case events written per transaction in write behind mode.')
+        parser.add_option('--reporting-queue-full',
+                          action='store',
+                          default='block',
+                          choices=['block', 'drop'],
+                          dest='reporting_queue_full',
+                          metavar='POLICY',
+                          help=('What to do when the write behind queue is full; "block" waits for '
+                                'space, "drop" does not record the case.'))
+        parser.add_option('--reporting-delivery',
+                          action='store',
+                          default='at-least-once',
+                          choices=['at-least-once', 'at-most-once'],
+                          dest='reporting_delivery',
+                          metavar='GUARANTEE',
+                          help=('"at-least-once" retries failed writes in write behind mode, '
+                                '"at-most-once" discards them.'))
+        parser.add_option('--reporting-bulk-size',
+                          action='store',
+                          default=0,
+                          dest='reporting_bulk_size',
+                          metavar='SIZE',
+                          type=int,
+                          help=('Buffer this many completed case executions and write them with bulk '
+                                'inserts.  Ignored with --reporting-write-behind.'))
+        parser.add_option('--reporting-long-lived-session',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_long_lived_session',
+                          help=('Reuse one database session for the whole run instead of opening '
+                                'a new one for every transaction.'))
+        parser.add_option('--reporting-bounded-memory',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_bounded_memory',
+                          help=('Release each completed case execution from the database session, '
+                                'keeping memory flat over very long runs.'))
+        parser.add_option('--reporting-lazy-default-cases',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_lazy_default_cases',
+                          help=('Only record the time between tests as an execution of the default '
+                                'case when a plugin records something against it.'))
+        parser.add_option('--reporting-case-cache-size',
+                          action='store',
+                          default=10000,
+                          dest='reporting_case_cache_size',
+                          metavar='SIZE',
+                          type=int,
+                          help='Number of test case ids to keep in memory; 0 disables the cache.')
+        parser.add_option('--reporting-preload-cases',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_preload_cases',
+                          help=('Load all tests before the run starts and look up their test cases '
+                                'in the reporting database in bulk.'))
+        parser.add_option('--reporting-longest-first',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_longest_first',
+                          help=('Run the tests that have taken longest in past runs first, so that '
+                                '--processes workers finish close together.'))
+        parser.add_option('--reporting-likely-failures-first',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_likely_failures_first',
+                          help=('Run the tests that have failed most often recently first, so that '
+                                'a broken build is reported early.  Takes precedence over '
+                                '--reporting-longest-first.'))
+        parser.add_option('--reporting-failure-history-days',
+                          action='store',
+                          default=14,
+                          dest='reporting_failure_history_days',
+                          metavar='DAYS',
+                          type=int,
+                          help='Days of results counted by --reporting-likely-failures-first.')
+        parser.add_option('--reporting-duration-history-days',
+                          action='store',
+                          default=30,
+                          dest='reporting_duration_history_days',
+                          metavar='DAYS',
+                          type=int,
+                          help=('Days of results read for the durations used by '
+                                '--reporting-longest-first and --shard.'))
+        parser.add_option('--shard',
+                          action='store',
+                          default=None,
+                          dest='reporting_shard',
+                          metavar='N/M',
+                          help=('Run only the Nth of M parts of the suite, split so that each part '
+                                'takes about as long, by past runs.  The parts only fit together if '
+                                'every host uses the same durations, so every host should read one '
+                                'shared --reporting-history-cache.'))
+        parser.add_option('--reporting-history-cache',
+                          action='store',
+                          default=env.get('sneeze_history_cache', None),
+                          dest='reporting_history_cache',
+                          metavar='DIRECTORY',
+                          help=('Directory to cache test history statistics from the reporting '
+                                'database in between runs.'))
+        parser.add_option('--reporting-history-cache-ttl',
+                          action='store',
+                          default=86400,
+                          dest='reporting_history_cache_ttl',
+                          metavar='SECONDS',
+                          type=float,
+                          help='Seconds before cached test history statistics are refreshed.')
+        parser.add_option('--reporting-schema',
+                          action='store',
+                          default=env.get('sneeze_schema', None),
+                          choices=['create', 'check', 'none'],
+                          dest='reporting_schema',
+                          metavar='MODE',
+                          help=('"create" creates missing tables, and the schema of an empty reporting '
+                                'database, "check" only verifies the schema version, "none" skips '
+                                'both.  Out of date databases are upgraded with sneeze-upgrade-db.  '
+                                'Defaults to "create" in the main process and "check" in '
+                                'multiprocess workers.'))
+        parser.add_option('--reporting-aggregate-workers',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_aggregate_workers',
+                          help=('With --processes, send case events from workers to the parent '
+                                'process, which writes them all over a single connection.'))
+        parser.add_option('--reporting-pool-size',
+                          action='store',
+                          default=env.get('sneeze_pool_size', None),
+                          dest='reporting_pool_size',
+                          metavar='SIZE',
+                          type=int,
+                          help='Number of connections kept open to the reporting database.')
+        parser.add_option('--reporting-pool-max-overflow',
+                          action='store',
+                          default=env.get('sneeze_pool_max_overflow', None),
+                          dest='reporting_pool_max_overflow',
+                          metavar='COUNT',
+                          type=int,
+                          help='Connections allowed beyond the pool size when the pool is exhausted.')
+        parser.add_option('--reporting-pool-recycle',
+                          action='store',
+                          default=env.get('sneeze_pool_recycle', None),
+                          dest='reporting_pool_recycle',
+                          metavar='SECONDS',
+                          type=int,
+                          help='Replace pooled connections older than this many seconds.')
+        parser.add_option('--reporting-pool-pre-ping',
+                          action='store_true',
+                          default=bool(env.get('sneeze_pool_pre_ping', '')),
+                          dest='reporting_pool_pre_ping',
+                          help='Test pooled connections before use and replace stale ones.')
+        parser.add_option('--reporting-spool',
+                          action='store',
+                          default=env.get('sneeze_spool', ''),
+                          dest='reporting_spool',
+                          metavar='PATH',
+                          help=('Record to a local SQLite spool at PATH and upload it to the reporting '
+                                'database when the run ends.'))
+        parser.add_option('--reporting-spool-defer-upload',
+                          action='store_true',
+                          default=False,
+                          dest='reporting_spool_defer_upload',
+                          help='Leave the spool for sneeze-upload-spool instead of uploading it at the end of the run.')
+        parser.add_option('--reporting-compact-addresses',
+                          action='store_true',
+                          default=bool(env.get('sneeze_compact_addresses')),
+                          dest='reporting_compact_addresses',
+                          help=('Store each distinct test address once instead of one row per '
+                                'address part per test.'))
+        parser.add_option('--reporting-timings',
+                          action='store',
+                          default=env.get('sneeze_timings', ''),
+                          dest='reporting_timings',
+                          metavar='PATH',
+                          help=('Time the work Sneeze does for each test and write p50/p95/p99 '
+                                'timings as JSON to PATH when the run ends.  Worker processes '
+                                'write to PATH.<pid>.'))
+        for add_options in iter_entry_points('nose.plugins.sneeze.plugins.add_options'):
             add_options.load()(parser, env)
     
     def configure(self, options, noseconfig):
@@ -98,55 +405,228 @@ class Sneeze(Plugin):
             # that, but it does, so we have to handle it in order to not end up with 2 Tissues (etc)
             # created in each worker and thus ending up with orphaned sneeze plugins that do bad things.
             if not (hasattr(self, 'tissue') and self.tissue):
-                environment = os.environ.get(options.pocket_change_environment_envvar,
-                                             '[no environment found]')
-                try:
-                    test_cycle_id = noseconfig.test_cycle_id
-                except AttributeError:
-                    test_cycle_id = options.test_cycle_id
-                    rerun_execution_ids = []
+                global _aggregator
+                from sneeze.database.interface import WorkerTissue
+                from sneeze.database.recorder import WorkerAggregator
+                host = resolve_host()
+                in_worker = current_process().name != 'MainProcess'
+                if in_worker and _aggregator is not None:
+                    self.tissue = WorkerTissue(_aggregator.worker_recorder(host, os.getpid()),
+                                               lazy_default_cases=options.reporting_lazy_default_cases)
                 else:
-                    rerun_execution_ids = options.case_execution_reruns
-                self.tissue = Tissue(options.reporting_db_config, options.test_cycle_name,
-                                     options.test_cycle_description, environment,
-                                     socket.gethostbyaddr(socket.gethostname())[0],
-                                     ' '.join(sys.argv), test_cycle_id=test_cycle_id,
-                                     rerun_execution_ids=rerun_execution_ids)
-                noseconfig.test_cycle_id = self.tissue.test_cycle.id
+                    self.tissue = self._make_tissue(options, noseconfig, host)
+                    noseconfig.test_cycle_id = self.tissue.test_cycle.id
+                    if (not in_worker and options.reporting_aggregate_workers
+                        and getattr(options, 'multiprocess_workers', 0)):
+                        _aggregator = WorkerAggregator(queue_size=options.reporting_queue_size,
+                                                       batch_size=options.reporting_batch_size,
+                                                       at_least_once=options.reporting_delivery == 'at-least-once')
+                        _aggregator.start(self.tissue)
+                worker_tissue = isinstance(self.tissue, WorkerTissue)
+                self.preload_cases = options.reporting_preload_cases and not worker_tissue
+                # Workers run the batches the main process has already ordered and sharded
+                self.longest_first = options.reporting_longest_first and not in_worker
+                self.likely_failures_first = (options.reporting_likely_failures_first
+                                              and not in_worker)
+                self.failure_history_days = options.reporting_failure_history_days
+                self.duration_history_days = options.reporting_duration_history_days
+                self.shard = None
+                if options.reporting_shard and not in_worker:
+                    from sneeze.database.scheduling import parse_shard
+                    self.shard = parse_shard(options.reporting_shard)
+                # Suites with fixtures reach workers whole, so workers skip the
+                # tests the main process left out of the shard
+                self.shard_excluded = getattr(noseconfig, 'sneeze_shard_excluded', None)
+                self.noseconfig = noseconfig
+                self.history_cache = options.reporting_history_cache
+                self.history_cache_ttl = options.reporting_history_cache_ttl
+                self.timings_path = options.reporting_timings
+                if self.timings_path and in_worker:
+                    self.timings_path += '.%d' % os.getpid()
                 Sneeze.enabled = True
-                for Manager in pkg_resources.iter_entry_points(group='nose.plugins.sneeze.plugins.managers'):
+                for Manager in iter_entry_points('nose.plugins.sneeze.plugins.managers'):
                     Manager = Manager.load()
                     if Manager.enabled(self.tissue, options, noseconfig):
-                        self.tissue.plugin_managers.append(Manager(self.tissue, options, noseconfig))
+                        self.tissue.add_plugin_manager(Manager(self.tissue, options, noseconfig))
                 self.tissue.start()
-                for manager in self.tissue.plugin_managers:
-                    if hasattr(manager, 'enter_test_cycle'):
-                        manager.enter_test_cycle()
-                if options.case_execution_reruns:
-                    CaseExecution = self.tissue.db_models['CaseExecution']
+                for hook in self.tissue.hooks('enter_test_cycle'):
+                    hook()
+                if ((options.case_execution_reruns or options.rerun_failures_cycle)
+                    and not worker_tissue):
+                    from sneeze.database.reruns import rerun_addresses, failure_addresses
                     with self.tissue.session_transaction() as session:
-                        case_executions = (session.query(CaseExecution)
-                                           .filter(CaseExecution.id.in_(options.case_execution_reruns))
-                                           .all())
-                        noseconfig.testNames = []
-                        for case_execution in case_executions:
-                            name = '{}:{}'.format(*[p.part for p in case_execution.address_parts[::2]])
-                            noseconfig.testNames.append(name)
+                        if options.case_execution_reruns:
+                            addresses = rerun_addresses(session, self.tissue.db_models,
+                                                        options.case_execution_reruns)
+                        else:
+                            addresses = failure_addresses(session, self.tissue.db_models,
+                                                          options.rerun_failures_cycle)
+                        noseconfig.testNames = ['{}:{}'.format(*parts[::2])
+                                                for execution_id, parts in addresses]
         else:
             self.tissue = None
             Sneeze.enabled = False
     
+    def _make_tissue(self, options, noseconfig, host):
+        
+        from sneeze.database.interface import Tissue
+        from sneeze.database.spool import spool_engine, prepare_spool
+        from sneeze.database.recorder import WriteBehindRecorder, BulkInsertRecorder
+        from sneeze.database.timings import Timings
+        environment = os.environ.get(options.pocket_change_environment_envvar,
+                                     '[no environment found]')
+        main_process = current_process().name == 'MainProcess'
+        if options.reporting_spool:
+            if options.case_execution_reruns or options.rerun_failures_cycle:
+                raise ValueError('--reporting-spool cannot be combined with reruns.')
+            engine = spool_engine(options.reporting_spool)
+            db_config_string = 'sqlite:///' + options.reporting_spool
+            upload_to = (options.reporting_db_config
+                         if main_process and not options.reporting_spool_defer_upload else None)
+        else:
+            engine = None
+            db_config_string = options.reporting_db_config
+            upload_to = None
+        try:
+            test_cycle_id = noseconfig.test_cycle_id
+        except AttributeError:
+            test_cycle_id = options.test_cycle_id
+            rerun_execution_ids = []
+            if not (test_cycle_id or options.test_cycle_name):
+                test_cycle_id = options.rerun_failures_cycle
+            if engine is not None:
+                # The cycle id refers to the reporting database; record against its
+                # stand in in the spool
+                test_cycle_id = prepare_spool(engine, test_cycle_id)
+        else:
+            rerun_execution_ids = options.case_execution_reruns
+        if options.reporting_write_behind:
+            recorder = WriteBehindRecorder(queue_size=options.reporting_queue_size,
+                                           batch_size=options.reporting_batch_size,
+                                           block=options.reporting_queue_full == 'block',
+                                           at_least_once=options.reporting_delivery == 'at-least-once')
+        elif options.reporting_bulk_size > 0:
+            recorder = BulkInsertRecorder(batch_size=options.reporting_bulk_size)
+        else:
+            recorder = None
+        schema = options.reporting_schema
+        if schema is None:
+            # The parent has already created the schema by the time workers start
+            schema = 'create' if main_process else 'check'
+        return Tissue(db_config_string, options.test_cycle_name,
+                      options.test_cycle_description, environment, host,
+                      ' '.join(sys.argv), test_cycle_id=test_cycle_id,
+                      rerun_execution_ids=rerun_execution_ids,
+                      engine=engine,
+                      upload_to=upload_to,
+                      timings=Timings() if options.reporting_timings else None,
+                      compact_addresses=options.reporting_compact_addresses,
+                      recorder=recorder,
+                      long_lived_session=options.reporting_long_lived_session,
+                      bounded_memory=options.reporting_bounded_memory,
+                      lazy_default_cases=options.reporting_lazy_default_cases,
+                      case_cache_size=options.reporting_case_cache_size,
+                      schema=schema,
+                      engine_options={'pool_size' : options.reporting_pool_size,
+                                      'max_overflow' : options.reporting_pool_max_overflow,
+                                      'pool_recycle' : options.reporting_pool_recycle,
+                                      'pool_pre_ping' : options.reporting_pool_pre_ping or None})
+    
+    def prepareTest(self, test):
+        
+        if not (self.preload_cases or self.longest_first or self.likely_failures_first
+                or self.shard is not None):
+            return
+        cases = _collect_tests(test)
+        labels = []
+        for case in cases:
+            try:
+                labels.append(_case_label(case))
+            except Exception:
+                # Not every runnable (ex nose Failures) has a usable address
+                labels.append(None)
+        if self.preload_cases:
+            self.tissue.preload_cases([label for label in labels if label is not None])
+        if self.longest_first or self.shard is not None:
+            from sneeze.database.scheduling import estimated_durations, assign_shards
+            durations = estimated_durations(labels, self._durations(labels))
+            if self.shard is not None:
+                index, count = self.shard
+                shards = assign_shards(durations, count)
+                _prune_suite(test, set(id(case) for case, shard in zip(cases, shards)
+                                       if shard == index))
+                # Passed to multiprocess workers with the pickled config
+                kept = set(label for label, shard in zip(labels, shards) if shard == index)
+                self.noseconfig.sneeze_shard_excluded = frozenset(
+                    label for label in labels if label is not None and label not in kept)
+        if self.longest_first or self.likely_failures_first:
+            rates = self._failure_rates() if self.likely_failures_first else {}
+            keys = {}
+            for i, case in enumerate(cases):
+                keys[id(case)] = (rates.get(labels[i], 0),
+                                  durations[i] if self.longest_first else 0)
+            _order_suite(test, keys, _run_order_key)
+    
+    def prepareTestCase(self, test):
+        
+        if self.shard_excluded:
+            try:
+                label = _case_label(test)
+            except Exception:
+                return None
+            if label in self.shard_excluded:
+                return _not_run
+    
+    def _history(self, name, compute, labels=()):
+        
+        from sneeze.database.scheduling import cached
+        path = None
+        if self.history_cache:
+            # Runs of other databases or test selections must not share a file
+            key = hashlib.sha1(str(self.tissue.engine.url))
+            for label in sorted(set(labels)):
+                if isinstance(label, unicode):
+                    label = label.encode('utf-8')
+                key.update('\n' + label)
+            path = os.path.join(self.history_cache, '%s-%s.json' % (name, key.hexdigest()))
+        return cached(path, self.history_cache_ttl, compute)
+    
+    def _durations(self, labels):
+        
+        from sneeze.database.scheduling import median_durations
+        
+        labels = [label for label in labels if label is not None]
+        
+        def compute():
+            
+            since = datetime.now() - timedelta(days=self.duration_history_days)
+            with self.tissue.session_transaction() as session:
+                return median_durations(session, self.tissue.db_models, labels, since)
+        
+        return self._history('durations-%dd' % self.duration_history_days, compute, labels)
+    
+    def _failure_rates(self):
+        
+        from sneeze.database.scheduling import failure_rates
+        
+        def compute():
+            
+            since = datetime.now() - timedelta(days=self.failure_history_days)
+            with self.tissue.session_transaction() as session:
+                return failure_rates(session, self.tissue.db_models, since)
+        
+        return self._history('failures-%dd' % self.failure_history_days, compute)
+    
     def startTest(self, test):
         
-        case_label = '.'.join(test.address()[1:])
+        case_label = _case_label(test)
         self.tissue.enter_case(case_label, test.address(), test.test.shortDescription())
     
     
     def peekError(self, test, err):
           
-        for manager in self.tissue.plugin_managers:
-            if hasattr(manager, 'peek_error'):
-                manager.peek_error(test, err)
+        for hook in self.tissue.hooks('peek_error'):
+            hook(test, err)
     
     def handleError(self, test, err):
         
@@ -164,14 +644,12 @@ class Sneeze(Plugin):
             error = err[1].message
         if err[0] in (SkipTest, DeprecatedTest):
             self.exit_state = 'SKIP'
-            for manager in self.tissue.plugin_managers:
-                if hasattr(manager, 'handle_skip'):
-                    manager.handle_skip(error)
+            for hook in self.tissue.hooks('handle_skip'):
+                hook(error)
         else:
             self.exit_state = 'FAIL'
-            for manager in self.tissue.plugin_managers:
-                if hasattr(manager, 'handle_fail'):
-                    manager.handle_fail(error)
+            for hook in self.tissue.hooks('handle_fail'):
+                hook(error)
 
     def addFailure(self, test, err):
         
@@ -180,16 +658,14 @@ class Sneeze(Plugin):
             error = err[1]
         else:
             error = err[1].message
-        for manager in self.tissue.plugin_managers:
-            if hasattr(manager, 'handle_fail'):
-                manager.handle_fail(error)
+        for hook in self.tissue.hooks('handle_fail'):
+            hook(error)
 
     def addSuccess(self, test):
         
         self.exit_state = 'PASS'
-        for manager in self.tissue.plugin_managers:
-            if hasattr(manager, 'handle_pass'):
-                manager.handle_pass()
+        for hook in self.tissue.hooks('handle_pass'):
+            hook()
     
     def stopTest(self, test):
         
@@ -197,8 +673,18 @@ class Sneeze(Plugin):
     
     def finalize(self, result):
         
-        self.tissue.exit()
+        if _aggregator is not None and _aggregator.tissue is self.tissue:
+            # Workers have all stopped by now; write whatever they left queued
+            _aggregator.close()
+        self.exit_tissue()
     
     def stopWorker(self, config):
         
-        self.tissue.exit()
\ No newline at end of file
+        self.exit_tissue()
+    
+    def exit_tissue(self):
+        
+        self.tissue.exit()
+        if self.timings_path and self.tissue.timings is not None:
+            with open(self.timings_path, 'w') as timings_file:
+                json.dump(self.tissue.timings.as_dict(), timings_file, indent=2, sort_keys=True)
\ No newline at end of file